@@ -0,0 +1,161 @@
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import constant
+import exceptions
+from detect import SnowDetector, decay_schedule, single_thread_opencv
+from stream import KeyframeIndex, SeekableFileStream
+from filter import Preprocessor
+
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.ts', '.flv')
+
+
+# Expand directories into the video files they contain
+def find_videos(paths):
+    videos = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                videos.extend(os.path.join(root, name) for name in files
+                              if name.lower().endswith(VIDEO_EXTENSIONS))
+        else:
+            videos.append(path)
+    return sorted(os.path.abspath(video) for video in videos)
+
+
+# Split a file into (file_idx, path, read_from, start, end) tasks.
+# Each task decodes from the keyframe at or before read_from but only reports
+# frames in [start, end), the frames before start warm up the background model.
+# Boundaries are kept on FRAME_HOP multiples so chunks analyse the same frames
+# a single pass would. The keyframe index is cached next to the file, so the
+# workers find it without probing the file again.
+def plan_chunks(file_idx, path, chunk_frames=constant.BATCH_CHUNK_FRAMES,
+                warmup_frames=constant.BATCH_WARMUP_FRAMES, hop=constant.FRAME_HOP):
+    total = KeyframeIndex.load(path).frames
+    if total <= 0 or not chunk_frames:
+        return [(file_idx, path, 0, 0, None)]
+
+    chunk_frames = max(hop, chunk_frames - chunk_frames % hop)
+    warmup_frames -= warmup_frames % hop
+
+    tasks = []
+    for start in range(0, total, chunk_frames):
+        end = min(start + chunk_frames, total)
+        tasks.append((file_idx, path, max(0, start - warmup_frames), start, end))
+    return tasks
+
+
+def _init_worker():
+    single_thread_opencv()
+
+
+# Run one chunk through its own detector with no display. Returns per frame
+# columns for the analysed frames in [start, end)
+def analyse_chunk(task, hop=constant.FRAME_HOP):
+    file_idx, path, read_from, start, end = task
+
+    # ffmpeg drops the skipped frames, one decoder thread per worker process
+    stream = SeekableFileStream(path, start_frame=read_from, end_frame=end, frame_hop=hop, threads=1)
+
+    # A decay schedule follows the time of day the chunk was recorded at
+    detector = SnowDetector(decay=decay_schedule(constant.DECAY_SCHEDULE, clock=stream.recorded_time))
+    frames, q_values, keypoints, thresholds = [], [], [], []
+
+    with stream:
+        filtered = Preprocessor().frames(stream)
+        try:
+            for frame in filtered:
+                q_value = detector.detect(frame)
+                if stream.frame >= start:
+                    frames.append(stream.frame)
+                    q_values.append(q_value)
+                    keypoints.append(len(detector._debug_keypoints))
+                    thresholds.append(detector.threshold)
+        except exceptions.StreamError:
+            # End of the range or file
+            pass
+
+    return (np.full(len(frames), file_idx, dtype=np.int32),
+            np.array(frames, dtype=np.int64),
+            np.array(q_values, dtype=np.int16),
+            np.array(keypoints, dtype=np.int32),
+            np.array(thresholds, dtype=np.float32))
+
+
+# Collapse consecutive snowing analysed frames into (file, start, end) events
+def snow_events(file_col, frame_col, snow_col, hop=constant.FRAME_HOP):
+    snow = snow_col.astype(bool)
+
+    # Frame i continues the run of frame i - 1 if both are in the same file and
+    # no analysed frame is missing in between
+    contiguous = np.zeros(len(snow), dtype=bool)
+    contiguous[1:] = (file_col[1:] == file_col[:-1]) & (frame_col[1:] - frame_col[:-1] == hop)
+
+    continues = contiguous & np.concatenate(([False], snow[:-1]))
+    continued = np.concatenate((continues[1:], [False]))
+    starts = np.flatnonzero(snow & ~continues)
+    ends = np.flatnonzero(snow & ~continued)
+
+    return file_col[starts], frame_col[starts], frame_col[ends] + 1
+
+
+def run(paths, output, workers=None, chunk_frames=constant.BATCH_CHUNK_FRAMES,
+        warmup_frames=constant.BATCH_WARMUP_FRAMES):
+    videos = find_videos(paths)
+    if not videos:
+        raise ValueError("No video files found in %s" % ", ".join(paths))
+
+    tasks = []
+    for file_idx, path in enumerate(videos):
+        tasks.extend(plan_chunks(file_idx, path, chunk_frames=chunk_frames, warmup_frames=warmup_frames))
+
+    print("Analysing %d files in %d chunks" % (len(videos), len(tasks)))
+    started = time.time()
+
+    pool = multiprocessing.Pool(processes=workers, initializer=_init_worker)
+    try:
+        results = list(pool.imap_unordered(analyse_chunk, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+    file_col, frame_col, q_col, keypoint_col, threshold_col = (np.concatenate(column) for column in zip(*results))
+
+    # Chunks finish in any order
+    order = np.lexsort((frame_col, file_col))
+    file_col, frame_col, q_col, keypoint_col, threshold_col = (
+        file_col[order], frame_col[order], q_col[order], keypoint_col[order], threshold_col[order])
+
+    snow_col = q_col > threshold_col
+    event_file, event_start, event_end = snow_events(file_col, frame_col, snow_col)
+
+    np.savez_compressed(output,
+                        files=np.array(videos),
+                        file=file_col, frame=frame_col, q_value=q_col, keypoints=keypoint_col,
+                        threshold=threshold_col, snow=snow_col,
+                        event_file=event_file, event_start=event_start, event_end=event_end)
+
+    elapsed = time.time() - started
+    print("Analysed %d frames in %.1fs (%.1f fps), %d snow events -> %s"
+          % (len(frame_col), elapsed, len(frame_col) / max(elapsed, 1e-9), len(event_file), output))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the snow detector over recorded video files')
+    parser.add_argument('paths', nargs='+', help='Video files or directories of video files')
+    parser.add_argument('--output', '-o', type=str, default='snow_batch.npz',
+                        help='Columnar (.npz) output with per frame QParam values and snow events')
+    parser.add_argument('--workers', '-j', type=int, default=None, help='Worker processes (default: all cores)')
+    parser.add_argument('--chunk-frames', type=int, default=constant.BATCH_CHUNK_FRAMES,
+                        help='Split files into ranges of this many frames (0 to disable)')
+    parser.add_argument('--warmup-frames', type=int, default=constant.BATCH_WARMUP_FRAMES,
+                        help='Frames decoded before each range to let the background model settle')
+    args = parser.parse_args()
+
+    run(args.paths, args.output, workers=args.workers, chunk_frames=args.chunk_frames,
+        warmup_frames=args.warmup_frames)
@@ -0,0 +1,313 @@
+import collections
+import json
+import math
+import os
+import subprocess
+import tempfile
+import time
+
+import cv2 as cv
+import numpy as np
+
+import constant
+from detect import SnowDetector, ComponentBlobDetector, BLOB_BACKENDS
+from filter import Preprocessor
+
+
+#
+# Deterministic synthetic snowfall.
+# A fixed noisy background with flakes falling at constant per flake speeds.
+# Every frame is a pure function of (seed, frame index), so the same video is
+# produced on every machine without access to the armorycam feed.
+#
+class SyntheticSnowfall(object):
+
+    def __init__(self, frames=600, width=constant.SourceFrameSize.WIDTH.value,
+                 height=constant.SourceFrameSize.HEIGHT.value, flakes=400, seed=0):
+        self.frames = frames
+        self.width = width
+        self.height = height
+        self.flakes = flakes
+
+        rng = np.random.RandomState(seed)
+
+        # Dim vertical gradient plus texture so the background model has something to learn
+        gradient = np.linspace(40, 110, height, dtype=np.float32)[:, None, None]
+        texture = rng.normal(0, 12, (height, width, 3)).astype(np.float32)
+        self._background = np.clip(gradient + texture, 0, 255).astype(np.uint8)
+
+        # A short cycle of sensor noise frames
+        self._noise = [rng.randint(-3, 4, (height, width, 3)).astype(np.int16) for _ in range(8)]
+
+        self._x0 = rng.uniform(0, width, flakes)
+        self._y0 = rng.uniform(0, height, flakes)
+        self._vx = rng.uniform(-2, 2, flakes)
+        self._vy = rng.uniform(4, 14, flakes)
+        self._radius = rng.randint(3, 9, flakes)
+
+    # Snow intensity ramps up and back down over the video
+    def active_flakes(self, idx):
+        return int(self.flakes * max(0.0, math.sin(math.pi * idx / max(self.frames, 1))))
+
+    def frame(self, idx):
+        frame = np.clip(self._background + self._noise[idx % len(self._noise)], 0, 255).astype(np.uint8)
+
+        count = self.active_flakes(idx)
+        xs = ((self._x0[:count] + self._vx[:count] * idx) % self.width).astype(np.int32)
+        ys = ((self._y0[:count] + self._vy[:count] * idx) % self.height).astype(np.int32)
+        for x, y, radius in zip(xs, ys, self._radius[:count]):
+            cv.circle(frame, (int(x), int(y)), int(radius), (255, 255, 255), -1, cv.LINE_AA)
+        return frame
+
+    def __iter__(self):
+        for idx in range(self.frames):
+            yield self.frame(idx)
+
+    def write(self, path, fps=constant.SOURCE_FPS):
+        writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*'mp4v'), fps, (self.width, self.height))
+        if not writer.isOpened():
+            raise IOError("Could not open video writer for %s" % path)
+        try:
+            for frame in self:
+                writer.write(frame)
+        finally:
+            writer.release()
+        return path
+
+
+# Collects wall clock durations per stage
+class StageTimer(object):
+
+    def __init__(self):
+        self.samples = {}
+
+    def time(self, stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.samples.setdefault(stage, []).append(time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        summary = {}
+        for stage, samples in self.samples.items():
+            samples = np.array(samples) * 1000.0
+            mean = float(samples.mean())
+            summary[stage] = {
+                'count': len(samples),
+                'mean_ms': mean,
+                'p50_ms': float(np.percentile(samples, 50)),
+                'p99_ms': float(np.percentile(samples, 99)),
+                'fps': 1000.0 / mean if mean else float('inf'),
+            }
+        return summary
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Time every stage of the detection hot path separately, analysing every frame
+def run_benchmark(stream, frames, warmup=25, detector_kwargs=None, scale=constant.PREPROCESS_SCALE,
+                  kernel_size=constant.PREPROCESS_KERNEL):
+    detector = SnowDetector(**(detector_kwargs or {}))
+    timer = StageTimer()
+
+    preprocessor = Preprocessor(scale=scale, kernel_size=kernel_size)
+
+    started = None
+    with stream:
+        for idx in range(warmup + frames):
+            if idx == warmup:
+                # Warm up frames settle the background model and caches
+                timer.samples.clear()
+                started = time.perf_counter()
+            frame_start = time.perf_counter()
+
+            frame = timer.time('decode', next, stream)
+
+            small = timer.time('preprocess', preprocessor, frame)
+
+            prepared, offset = timer.time('prepare', detector._prepare, small)
+            masked = timer.time('mask', detector._mask_out_areas, prepared)
+            fgmask = timer.time('mog2', detector._foreground, masked)
+            keypoints = timer.time('blobs', detector._find_blobs, fgmask, offset)
+            timer.time('qparam', detector._q_param.update, keypoints)
+
+            timer.samples.setdefault('total', []).append(time.perf_counter() - frame_start)
+
+    elapsed = time.perf_counter() - started
+    return {
+        'frames': frames,
+        'elapsed_s': elapsed,
+        'throughput_fps': frames / elapsed if elapsed else float('inf'),
+        'stages': timer.summary(),
+    }
+
+
+# Run both blob backends over the same foreground masks and report the
+# frames where their keypoint counts differ. The components backend has to
+# count exactly what SimpleBlobDetector counts, or QParam and every threshold
+# tuned on it shift
+def blob_parity(stream, frames, warmup=25, scale=constant.PREPROCESS_SCALE, kernel_size=constant.PREPROCESS_KERNEL):
+    detector = SnowDetector()
+    params = detector._get_blob_detector_params()
+    backends = {'simple': cv.SimpleBlobDetector_create(params),
+                'components': ComponentBlobDetector.from_params(params)}
+    preprocessor = Preprocessor(scale=scale, kernel_size=kernel_size)
+
+    totals = dict((name, 0) for name in backends)
+    mismatched = []
+    with stream:
+        for idx in range(warmup + frames):
+            prepared, _ = detector._prepare(preprocessor(next(stream)))
+            fgmask = detector._foreground(detector._mask_out_areas(prepared))
+            if idx < warmup:
+                continue
+
+            counts = dict((name, len(backend.detect(fgmask))) for name, backend in backends.items())
+            for name, count in counts.items():
+                totals[name] += count
+            if counts['simple'] != counts['components']:
+                mismatched.append((idx - warmup, counts['simple'], counts['components']))
+
+    return {'frames': frames, 'keypoints': totals, 'mismatched': mismatched}
+
+
+# Foreground masks far denser than any real snowfall: a grid of 3 x 3 px
+# blobs where every blob is near its neighbours, and dilated noise. These are
+# the worst cases for grouping blobs
+def dense_masks(width=constant.FrameSize.WIDTH.value, height=constant.FrameSize.HEIGHT.value, seed=0):
+    masks = collections.OrderedDict()
+    for spacing in (10, 8, 6):
+        mask = np.zeros((height, width), dtype=np.uint8)
+        for y in range(2, height - 3, spacing):
+            for x in range(2, width - 3, spacing):
+                mask[y:y + 3, x:x + 3] = 255
+        masks['grid%d' % spacing] = mask
+
+    rng = np.random.RandomState(seed)
+    noise = ((rng.rand(height, width) < .02) * 255).astype(np.uint8)
+    masks['noise2%'] = cv.dilate(noise, np.ones((2, 2), dtype=np.uint8))
+    return masks
+
+
+# Time both blob backends on every mask, best of `repeats` runs
+def blob_dense(masks, repeats=3):
+    params = SnowDetector._get_blob_detector_params()
+    backends = {'simple': cv.SimpleBlobDetector_create(params),
+                'components': ComponentBlobDetector.from_params(params)}
+
+    results = collections.OrderedDict()
+    for name, mask in masks.items():
+        result = {}
+        for backend_name, backend in backends.items():
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                keypoints = backend.detect(mask)
+                timings.append(time.perf_counter() - start)
+            result[backend_name] = {'ms': 1000.0 * min(timings), 'keypoints': len(keypoints)}
+        results[name] = result
+    return results
+
+
+def print_results(results, baseline=None):
+    print("%d frames, %.1f fps" % (results['frames'], results['throughput_fps']))
+    print("%-10s %10s %10s %10s %10s" % ('stage', 'mean ms', 'p50 ms', 'p99 ms', 'vs base'))
+    for stage, stats in results['stages'].items():
+        change = ''
+        if baseline and stage in baseline['stages']:
+            base = baseline['stages'][stage]['p50_ms']
+            if base:
+                change = "%+.1f%%" % (100.0 * (stats['p50_ms'] - base) / base)
+        print("%-10s %10.3f %10.3f %10.3f %10s" % (stage, stats['mean_ms'], stats['p50_ms'], stats['p99_ms'], change))
+
+
+if __name__ == '__main__':
+    import argparse
+    from stream import ArmoryCamStream, FileStream
+
+    parser = argparse.ArgumentParser(description='Benchmark the snow detection hot path')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--file', '-f', type=str, help='Recorded video to benchmark against')
+    source.add_argument('--live', action='store_true', help='Benchmark against the live armorycam stream')
+    parser.add_argument('--frames', type=int, default=500, help='Frames to time (after warm up)')
+    parser.add_argument('--warmup', type=int, default=25, help='Frames to run before timing starts')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic snowfall video')
+    parser.add_argument('--flakes', type=int, default=400, help='Peak number of synthetic snowflakes')
+    parser.add_argument('--blob-backend', choices=BLOB_BACKENDS, default=constant.BLOB_BACKEND,
+                        help='Blob counter to benchmark')
+    parser.add_argument('--output', '-o', type=str, default=None, help='Write results as JSON to this file')
+    parser.add_argument('--compare', type=str, default=None, help='JSON results of a previous run to compare to')
+    parser.add_argument('--parity', action='store_true',
+                        help='Check the components blob backend counts the same keypoints as the simple one')
+    parser.add_argument('--dense', action='store_true',
+                        help='Time both blob backends on dense synthetic foreground masks')
+    args = parser.parse_args()
+
+    if args.dense:
+        dense = blob_dense(dense_masks(seed=args.seed))
+        print("%-10s %12s %12s %10s %10s" % ('mask', 'simple ms', 'comp. ms', 'simple', 'comp.'))
+        for name, result in dense.items():
+            print("%-10s %12.1f %12.1f %10d %10d" % (name, result['simple']['ms'], result['components']['ms'],
+                                                      result['simple']['keypoints'],
+                                                      result['components']['keypoints']))
+        raise SystemExit(1 if any(result['simple']['keypoints'] != result['components']['keypoints']
+                                  for result in dense.values()) else 0)
+
+    total_frames = args.frames + args.warmup
+    synthetic_path = None
+    if args.live:
+        stream = ArmoryCamStream()
+        source_name = constant.STREAM_URL
+    elif args.file:
+        stream = FileStream(args.file)
+        source_name = os.path.abspath(args.file)
+    else:
+        synthetic = SyntheticSnowfall(frames=total_frames, flakes=args.flakes, seed=args.seed)
+        synthetic_path = os.path.join(tempfile.mkdtemp(), 'synthetic_snowfall.mp4')
+        synthetic.write(synthetic_path)
+        stream = FileStream(synthetic_path)
+        source_name = 'synthetic(seed=%d, flakes=%d)' % (args.seed, args.flakes)
+
+    try:
+        if args.parity:
+            parity = blob_parity(stream, args.frames, warmup=args.warmup)
+        else:
+            results = run_benchmark(stream, args.frames, warmup=args.warmup,
+                                    detector_kwargs={'blob_backend': args.blob_backend})
+    finally:
+        if synthetic_path is not None:
+            os.remove(synthetic_path)
+            os.rmdir(os.path.dirname(synthetic_path))
+
+    if args.parity:
+        print("%d frames, keypoints %s, %d frames differ"
+              % (parity['frames'], " ".join("%s=%d" % item for item in sorted(parity['keypoints'].items())),
+                 len(parity['mismatched'])))
+        for idx, simple, components in parity['mismatched'][:20]:
+            print("frame %d: simple=%d components=%d" % (idx, simple, components))
+        raise SystemExit(1 if parity['mismatched'] else 0)
+
+    results.update({
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'source': source_name,
+        'opencv': cv.__version__,
+        'blob_backend': args.blob_backend,
+    })
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
@@ -6,23 +6,21 @@ TEST_URL = 'C:/Users/wgolembi/Desktop/armory_analytics/samples/false_positive.mp
 #TEST_URL = '/home/wgolembi/aa/armory_analytics/very_light.mp4'
 #FFMPEG_PATH = os.path.dirname(__file__) + '/ffmpeg-4.2.1/bin/ffmpeg.exe'
 FFMPEG_PATH = "/usr/bin/ffmpeg"
+FFPROBE_PATH = os.path.join(os.path.dirname(FFMPEG_PATH), 'ffprobe')
 
-FFMPEG_COMMAND = [FFMPEG_PATH, '-i', STREAM_URL,
-                  '-loglevel', 'quiet',  # no text output
-                  '-r 24',
-                  '-an',  # disable audio
-                  '-f', 'image2pipe',
-                  '-pix_fmt', 'bgr24',
-                  '-vcodec', 'rawvideo', '-',
-                  ]
+# Live decode options, see stream.decode_command
+FFMPEG_LOGLEVEL = 'quiet'           # ffmpeg log level, 'error' or 'warning' when debugging the feed
+FFMPEG_DECODE_THREADS = 0           # Decoder threads, 0 lets ffmpeg pick one per core
+FFMPEG_LOW_DELAY = True             # -fflags nobuffer -flags low_delay, skip input buffering on the live feed
+FFMPEG_ANALYZE_DURATION_US = 1000000    # How long ffmpeg probes the input before decoding (microseconds)
+FFMPEG_PROBE_SIZE = 1000000         # Bytes ffmpeg may read while probing the input
+FFMPEG_LIVE_START_INDEX = -1        # HLS segment to start from, negative counts back from the live edge
+FFMPEG_PIX_FMT = 'bgr24'            # Pixel format piped out of ffmpeg, 'bgr24' or 'gray'
 
-FFMPEG_TWITCH = [FFMPEG_PATH, '-f', 'x11grab -s 1920x1200 -framerate 15',
-                 '-i:0.0 -c:v libx264 -preset fast -pix_fmt yuv440p -s 1280x800',
-                 '-threads 0 -f flv]'
-                 ]
-
-FFMPEG_TWITCH = " ".join(FFMPEG_TWITCH)
-FFMPEG_COMMAND = " ".join(FFMPEG_COMMAND)
+# Screen grab straight to flv, for manual restream tests
+FFMPEG_TWITCH = [FFMPEG_PATH, '-f', 'x11grab', '-s', '1920x1200', '-framerate', '15', '-i', ':0.0',
+                 '-c:v', 'libx264', '-preset', 'fast', '-pix_fmt', 'yuv420p', '-s', '1280x800',
+                 '-threads', '0', '-f', 'flv']
 
 class FrameSize(Enum):
     HEIGHT = 270
@@ -30,12 +28,78 @@ class FrameSize(Enum):
     #WIDTH = 960
     #HEIGHT = 540
 
+# Resolution of the armorycam HLS feed
+class SourceFrameSize(Enum):
+    HEIGHT = 1080
+    WIDTH = 1920
+
+# Regions of interest in FrameSize coordinates. Everything outside of these
+# polygons is masked out before detection.
+ROI_POLYGONS = [
+    [(0, 42), (130, 65), (130, 85), (0, 137)],
+    [(220, 0), (325, 0), (325, 125), (255, 125)],
+]
+
+SOURCE_FPS = 24                     # Frame rate ffmpeg decodes the live stream at
+FRAME_HOP = 5                       # Analyse every FRAME_HOP'th frame
+ANALYSIS_FPS = SOURCE_FPS / FRAME_HOP
+FRAME_POOL_SIZE = 4                 # Preallocated frames the ffmpeg pipe reader cycles through
+PREPROCESS_SCALE = .25              # Resize factor from the source resolution to the analysed frames
+PREPROCESS_KERNEL = 3               # Gaussian blur kernel applied to analysed frames
+
+FROZEN_STREAM_SECS = 5              # Identical frames for this long means the feed is frozen
+FINGERPRINT_STRIDE = 16             # Pixel stride of the per frame fingerprint used to spot frozen frames
+STREAM_READ_TIMEOUT_SECS = 15       # No frame data for this long means the ffmpeg pipe has stalled
+STREAM_START_TIMEOUT_SECS = 45      # Allowance for the first frame after (re)starting ffmpeg
+STREAM_RESTART_BACKOFF_SECS = 1     # First delay before restarting ffmpeg, doubled per failed restart
+STREAM_RESTART_MAX_BACKOFF_SECS = 60
+STREAM_MAX_RESTARTS = 10            # Give up after this many restarts without FROZEN_STREAM_SECS of good frames
+
+PIPELINE_QUEUE_SIZE = 2             # Frames each threaded pipeline stage may queue before dropping
+PIPELINE_STATS_SECS = 10            # How often the threaded pipeline reports queue depths
+MULTICAM_QUEUE_SIZE = 4             # Frames queued per analysis worker before readers start dropping
+RESTREAM_QUEUE_SIZE = 8             # Frames queued for the restream encoder before dropping
+
+BATCH_CHUNK_FRAMES = SOURCE_FPS * 60 * 10   # Split recordings into 10 minute ranges for batch analysis
+BATCH_WARMUP_FRAMES = SOURCE_FPS * 20       # Frames decoded ahead of each range to settle the background model
+
+DETECT_CHANNEL = None               # None (BGR), 'gray' or a channel index fed to the background model
+DETECT_CROP = False                 # Only feed the ROI bounding box to the background model
+BLOB_BACKEND = 'simple'             # 'simple' (cv.SimpleBlobDetector) or 'components' (same counts, single contour pass)
+
 IMPULSE_DECAY = 4
+DECAY_SCHEDULE = None               # None (fixed IMPULSE_DECAY), 'adaptive' or {hour: decay}, e.g. {7: 4, 17: 6}
+DECAY_MAX = 12                      # Highest decay the adaptive schedule may pick
+NOISE_FLOOR_QUANTILE = .25          # Quantile of keypoint counts tracked as the noise floor
+NOISE_FLOOR_RATE = .01              # Keypoints the noise floor estimate may move per frame
+NOISE_FLOOR_MARGIN = 2              # Headroom above the noise floor before frames count as snow
+
+MOTION_GATE = False                 # Skip the background model on frames where nothing in the ROI moved
+MOTION_GATE_THRESHOLD = .001        # Fraction of changed pixels that counts as motion
+MOTION_GATE_PIXEL_DIFF = 10         # Grey level change for a pixel to count as changed
+MOTION_GATE_SCALE = .5              # Downscale of the ROI the motion score is computed on
+MOTION_GATE_REFRESH = 10            # Run the full path at least every this many analysed frames
+
+CHECKPOINT_INTERVAL_SECS = 60 * 5   # How often SnowDetector saves its background model when checkpointing
+CHECKPOINT_MAX_AGE_SECS = 60 * 60   # Checkpoints older than this are ignored on startup
 
 DEBUG = False
+METRICS_PORT = 9187                 # Local port the Prometheus metrics endpoint listens on (0 to disable)
 STREAMING = False
 
 NOTIFY_EVENT_WINDOW_SECS = 60       # Time for event window (length of "pseudo circular buffer")
 NOTIFY_THRESHOLD = .5                # % event window filled with snow_events to trigger notification
 NOT_SNOWING_THRESHOLD = .9           # % event window that needs to be filled with no_snow_events to dictate no snow
 NOTIF_REFRACTORY_SECS = 60 * 30      # Number of seconds of no snow to reset notification trigger
+
+JOURNAL_BUFFER_RECORDS = 64         # Frame records buffered before the event journal writes them out
+
+SNAPSHOT_JPEG_QUALITY = 90           # JPEG quality of the snapshot attached to notifications
+
+YO_URL = 'http://api.justyo.co/yo/'
+NOTIF_HTTP_POOL_SIZE = 4             # Pooled connections per host for notification HTTP calls
+NOTIF_HTTP_TIMEOUT_SECS = 10         # Timeout for a single notification HTTP call
+NOTIF_RETRY_BASE_SECS = 1            # First retry delay, doubled after every failed attempt
+NOTIF_RETRY_MAX_SECS = 60            # Longest delay between retries
+NOTIF_RETRY_DEADLINE_SECS = 60 * 10  # Give up on a channel this long after the notification
+NOTIF_STOP_TIMEOUT_SECS = 30         # Longest wait on shutdown for notifications still being sent
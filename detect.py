@@ -1,41 +1,542 @@
+import json
+import logging
+import math
+import os
+import time
+import zipfile
 import cv2 as cv
 import numpy as np
 import constant
+import metrics
+
+logger = logging.getLogger(__name__)
 
 
 # Impulse control
 # Control change in matches over time.
 # Decay the number of matches by constant.IMPULSE_DECAY every frame
 # and see if the number of matches can keep the average high.
-# Decay argument will be the controlling variable
-# Decay may change over the course of the day, might have to set based on time
+# Decay argument will be the controlling variable. It is either a fixed
+# number or a schedule (DecaySchedule, NoiseFloorDecay) that changes it over
+# the course of the day
 class QParam(object):
     def __init__(self, min=0, max=255, decay=constant.IMPULSE_DECAY):
         self.value = 0
         self.min = min
         self.max = max
-        self.decay = decay  # Decay of num keypoints matched per frame
+        self._schedule = decay if hasattr(decay, 'current') else None
+        # Decay of num keypoints matched per frame
+        self.decay = decay if self._schedule is None else self._schedule.current()
+
+    # QParam values above this count as snow. Tracks the decay schedule
+    @property
+    def threshold(self):
+        return self.decay + 1
 
     # Lightweight impulse response function
     def update(self, keypoints):
+        if self._schedule is not None:
+            self.decay = self._schedule.current()
+
         growth = (len(keypoints)*8) / max(self.value, 1)  # Get growth percent of max
         delta = growth - self.decay
         self.value = int(min(max(self.value + delta, self.min), self.max))
 
+        if self._schedule is not None:
+            self._schedule.observe(len(keypoints))
+
         # Return impulse function adjusted value
         return self.value
 
 
+#
+# Decay by time of day. `table` maps the hour (fractions allowed) a decay
+# starts at to that decay, e.g. {7: 4, 16.5: 6, 22: 5}; the last entry wraps
+# around midnight. Expanded once into a per minute lookup table, and the
+# local time is only looked up again when the minute changes.
+#
+class DecaySchedule(object):
+
+    def __init__(self, table, clock=time.time):
+        if not table:
+            raise ValueError("Decay schedule needs at least one (hour, decay) entry")
+        starts = sorted((float(hour) % 24 * 60, float(decay)) for hour, decay in table.items())
+
+        self._lookup = []
+        for minute in range(24 * 60):
+            decay = starts[-1][1]
+            for start, start_decay in starts:
+                if start <= minute:
+                    decay = start_decay
+            self._lookup.append(decay)
+
+        self._clock = clock
+        self._minute = None
+        self._decay = None
+
+    def current(self):
+        minute = int(self._clock() // 60)
+        if minute != self._minute:
+            now = time.localtime(minute * 60)
+            self._minute = minute
+            self._decay = self._lookup[now.tm_hour * 60 + now.tm_min]
+        return self._decay
+
+    def observe(self, keypoints):
+        pass
+
+
+#
+# Decay learned from the running noise floor of keypoint counts, tracked as a
+# low quantile with an O(1) stochastic update per frame. The decay is the
+# smallest one whose threshold a steady `margin` x noise floor keypoints per
+# frame cannot exceed: QParam settles at keypoints * 8 / decay, so this solves
+# decay * (decay + 1) = 8 * margin * floor. Precomputed per 1/STEPS keypoint.
+#
+class NoiseFloorDecay(object):
+    STEPS = 4
+
+    def __init__(self, base=constant.IMPULSE_DECAY, maximum=constant.DECAY_MAX,
+                 quantile=constant.NOISE_FLOOR_QUANTILE, rate=constant.NOISE_FLOOR_RATE,
+                 margin=constant.NOISE_FLOOR_MARGIN):
+        self.quantile = quantile
+        self.rate = rate
+        self.floor = 0.0
+
+        # No point tracking the floor past where the decay is capped
+        top = int(math.ceil(maximum * (maximum + 1) / (8.0 * margin) * self.STEPS)) + 1
+        self._lookup = [min(max(base, (math.sqrt(1 + 32.0 * margin * step / self.STEPS) - 1) / 2), maximum)
+                        for step in range(top + 1)]
+
+    def current(self):
+        return self._lookup[min(int(self.floor * self.STEPS), len(self._lookup) - 1)]
+
+    def observe(self, keypoints):
+        self.floor = max(0.0, self.floor + self.rate * (self.quantile - (keypoints < self.floor)))
+
+
+# Build the QParam decay from a --decay-schedule style spec: None for the
+# fixed `decay`, 'adaptive' for NoiseFloorDecay, an {hour: decay} dict or the
+# path of a JSON file holding one. `clock` gives the Unix time of the frame
+# being analysed, e.g. SeekableFileStream.recorded_time for recordings
+def decay_schedule(spec, decay=constant.IMPULSE_DECAY, clock=time.time):
+    if spec is None:
+        return decay
+    if spec == 'adaptive':
+        return NoiseFloorDecay(base=decay)
+    if not isinstance(spec, dict):
+        with open(spec) as schedule_file:
+            spec = json.load(schedule_file)
+    return DecaySchedule(spec, clock=clock)
+
+
+# Call in worker processes that each run their own detectors. With a process
+# per core already, OpenCV's own thread pool only oversubscribes the cores
+def single_thread_opencv():
+    cv.setNumThreads(1)
+
+
+# Bounding (x, y, width, height) rectangle around a set of ROI polygons
+def roi_bounding_rect(polygons=constant.ROI_POLYGONS):
+    points = np.array([point for polygon in polygons for point in polygon], dtype=np.int32)
+    return cv.boundingRect(points)
+
+
+# Load ROI polygons from a JSON file holding a list of polygons, each a list
+# of [x, y] points in FrameSize coordinates
+def load_roi_polygons(path):
+    with open(path) as roi_file:
+        polygons = json.load(roi_file)
+
+    if not polygons or any(len(polygon) < 3 for polygon in polygons):
+        raise ValueError("ROI config %s needs at least one polygon of 3 or more points" % path)
+    return [[(int(x), int(y)) for x, y in polygon] for polygon in polygons]
+
+
+#
+# Region of interest mask.
+# The polygons are rasterised once per frame shape and cached. Masking only
+# touches the bounding box of the polygons, using a single channel mask, and
+# writes into a reused output frame that stays black outside of the box.
+#
+class RoiMask(object):
+
+    # origin: (x, y) of the top left corner of incoming frames in FrameSize
+    #         coordinates. Non zero when the stream is cropped by the decoder
+    def __init__(self, polygons=constant.ROI_POLYGONS, origin=(0, 0)):
+        self.polygons = [np.array([[(x - origin[0], y - origin[1]) for x, y in polygon]], dtype=np.int32)
+                         for polygon in polygons]
+        self._size = None
+        self._mask = None
+        self._masked = None
+        self._masked_crop = None
+        self.rect = None
+
+    def _build(self, size):
+        height, width = size
+
+        mask = np.zeros((height, width), dtype=np.uint8)
+        for polygon in self.polygons:
+            cv.fillPoly(mask, polygon, 255)
+
+        # Clip the polygon bounding box to the frame
+        x, y, w, h = cv.boundingRect(np.concatenate(self.polygons, axis=1).reshape(-1, 2))
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, width), min(y + h, height)
+
+        self.rect = (x0, y0, max(x1 - x0, 0), max(y1 - y0, 0))
+        self._slices = (slice(y0, y1), slice(x0, x1))
+        self._mask = np.ascontiguousarray(mask[self._slices])
+        self._masked = None
+        self._masked_crop = None
+        self._size = size
+
+    def _check(self, frame):
+        if frame.shape[:2] != self._size:
+            self._build(frame.shape[:2])
+
+    # View of the frame cropped to the bounding box of the polygons
+    def crop(self, frame):
+        self._check(frame)
+        return frame[self._slices]
+
+    # Returns the masked frame. The returned array is reused on the next call
+    def apply(self, frame):
+        self._check(frame)
+        if self._masked is None or self._masked.shape != frame.shape:
+            self._masked = np.zeros(frame.shape, dtype=np.uint8)
+
+        src = frame[self._slices]
+        cv.bitwise_and(src, src, dst=self._masked[self._slices], mask=self._mask)
+        return self._masked
+
+    # Mask a frame that has already been cropped with crop(). The returned
+    # array is reused on the next call
+    def apply_cropped(self, cropped):
+        if self._masked_crop is None or self._masked_crop.shape != cropped.shape:
+            # Zeroed, the masked AND leaves pixels outside the polygons untouched
+            self._masked_crop = np.zeros(cropped.shape, dtype=np.uint8)
+
+        cv.bitwise_and(cropped, cropped, dst=self._masked_crop, mask=self._mask)
+        return self._masked_crop
+
+
+#
+# Blob counter for the binary foreground mask. SimpleBlobDetector re-finds
+# the same contours at every threshold level of a 0/255 mask; this finds them
+# once and applies the same rules: contour moment area in [min_area,
+# max_area), centre on a foreground pixel, and blobs closer than `min_dist`
+# (or their radii) grouped across levels, keeping groups seen at least
+# `min_repeatability` times.
+# Returns KeyPoints, so counting and drawing work unchanged.
+#
+class ComponentBlobDetector(object):
+
+    # levels: Threshold levels SimpleBlobDetector would have swept, every
+    #         blob is seen once per level
+    def __init__(self, min_area=2, max_area=20, min_dist=10, min_repeatability=2, levels=20):
+        self.min_area = min_area
+        self.max_area = max_area
+        self.min_dist = min_dist
+        self.min_repeatability = min_repeatability
+        self.levels = levels
+
+    @classmethod
+    def from_params(cls, params):
+        levels = len(range(int(params.minThreshold), int(params.maxThreshold), int(params.thresholdStep)))
+        return cls(min_area=params.minArea, max_area=params.maxArea, min_dist=params.minDistBetweenBlobs,
+                   min_repeatability=params.minRepeatability, levels=levels)
+
+    # (x, y, radius) of every contour passing the area and colour filters
+    def _blobs(self, fgmask):
+        # [-2] picks the contours from both the OpenCV 3 and 4 return values
+        contours = cv.findContours(fgmask, cv.RETR_LIST, cv.CHAIN_APPROX_NONE)[-2]
+        if not len(contours):
+            return np.zeros((0, 3))
+
+        # Contour moments for every contour at once. The sums are exact
+        # integers, scaled the way cv.moments scales them so centres and radii
+        # come out bit for bit the same as SimpleBlobDetector's and ties break
+        # the same way when grouping. The area runs through the boundary pixel
+        # centres: about (w - 1) * (h - 1) for a w x h blob and zero for 1 px
+        # wide blobs
+        lengths = np.array([len(contour) for contour in contours])
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        points = np.concatenate(contours).reshape(-1, 2).astype(np.float64)
+        following = np.arange(1, len(points) + 1)
+        following[starts + lengths - 1] = starts
+        x, y = points[:, 0], points[:, 1]
+        x1, y1 = x[following], y[following]
+        cross = x * y1 - x1 * y
+        twice_area = np.add.reduceat(cross, starts)
+        sign = np.sign(twice_area)
+        area = twice_area * sign * .5
+
+        keep = np.flatnonzero((area >= self.min_area) & (area < self.max_area) & (area > 0))
+        if not len(keep):
+            return np.zeros((0, 3))
+        cx = np.add.reduceat((x + x1) * cross, starts)[keep] * sign[keep] * (1. / 6) / area[keep]
+        cy = np.add.reduceat((y + y1) * cross, starts)[keep] * sign[keep] * (1. / 6) / area[keep]
+
+        # The centre has to land on the blob (filterByColor)
+        on_blob = fgmask[np.rint(cy).astype(np.intp), np.rint(cx).astype(np.intp)] == 255
+        cx, cy, keep = cx[on_blob], cy[on_blob], keep[on_blob]
+        if not len(keep):
+            return np.zeros((0, 3))
+
+        # Radius is the median distance from the centre to the contour
+        kept_lengths = lengths[keep]
+        owner = np.repeat(np.arange(len(keep)), kept_lengths)
+        idx = np.concatenate([np.arange(start, start + length) for start, length in zip(starts[keep], kept_lengths)])
+        dx, dy = x[idx] - cx[owner], y[idx] - cy[owner]
+        dist = np.sqrt(dx * dx + dy * dy)
+        dist = dist[np.lexsort((dist, owner))]
+        first = np.concatenate(([0], np.cumsum(kept_lengths)[:-1]))
+        radius = (dist[first + (kept_lengths - 1) // 2] + dist[first + kept_lengths // 2]) / 2
+        return np.stack([cx, cy, radius], axis=1)
+
+    # Pairs (i, j) of blobs SimpleBlobDetector would group, closer than
+    # minDist and both radii, sorted by i. Every blob pairs with itself.
+    # Pairs are at most `reach` apart, so only blobs in neighbouring cells of a
+    # grid that coarse are compared
+    def _pairs(self, centres, radii):
+        reach = max(self.min_dist, radii.max())
+        cells = np.floor(centres / reach).astype(np.int64)
+        cells -= cells.min(axis=0) - 1
+        rows = cells[:, 1].max() + 2
+        keys = cells[:, 0] * rows + cells[:, 1]
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+
+        pairs = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                target = keys + dx * rows + dy
+                lo = np.searchsorted(sorted_keys, target, 'left')
+                counts = np.searchsorted(sorted_keys, target, 'right') - lo
+                total = counts.sum()
+                if not total:
+                    continue
+                i = np.repeat(np.arange(len(keys)), counts)
+                j = order[np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(total)]
+                pairs.append((i, j))
+        i = np.concatenate([pair[0] for pair in pairs])
+        j = np.concatenate([pair[1] for pair in pairs])
+
+        dx, dy = centres[i, 0] - centres[j, 0], centres[i, 1] - centres[j, 1]
+        dist = np.sqrt(dx * dx + dy * dy)
+        near = dist < np.maximum(self.min_dist, np.maximum(radii[i], radii[j]))
+        i, j = i[near], j[near]
+        order = np.lexsort((j, i))
+        return i[order], j[order]
+
+    # Label every blob with the lowest index of the cluster of blobs connected
+    # to it through pairs. Pointer jumping keeps the number of passes down to
+    # about log of the cluster diameter
+    @staticmethod
+    def _clusters(count, i, j):
+        labels = np.arange(count)
+        while True:
+            merged = labels.copy()
+            np.minimum.at(merged, i, labels[j])
+            merged = merged[merged]
+            if np.array_equal(merged, labels):
+                return labels
+            labels = merged
+
+    # Replay SimpleBlobDetector's grouping of one cluster of nearby blobs
+    # over its threshold levels. Each blob joins the first group whose median
+    # radius member it is near, or starts a new group. Groups are indexed by
+    # that member, and `first` holds the lowest group each member leads, so a
+    # blob only looks at one number per neighbour
+    def _group(self, cluster, neighbours, radii):
+        groups = [[idx] for idx in cluster]
+        led = dict((idx, {pos}) for pos, idx in enumerate(cluster))
+        first = dict((idx, pos) for pos, idx in enumerate(cluster))
+        none = len(cluster) * self.levels
+
+        lowest = first.__getitem__
+        for _ in range(self.levels - 1):
+            started = []
+            for idx in cluster:
+                pos = min(map(lowest, neighbours[idx]))
+                if pos == none:
+                    started.append(idx)
+                    continue
+
+                group = groups[pos]
+                size = len(group)
+                ref = group[size // 2]
+                # Members stay sorted by radius
+                radius = radii[idx]
+                at = size
+                while at and radius < radii[group[at - 1]]:
+                    at -= 1
+                group.insert(at, idx)
+                new_ref = group[(size + 1) // 2]
+                if new_ref != ref:
+                    led[ref].discard(pos)
+                    first[ref] = min(led[ref], default=none)
+                    led.setdefault(new_ref, set()).add(pos)
+                    if pos < first[new_ref]:
+                        first[new_ref] = pos
+
+            # Groups started on this level only take members from the next one
+            for idx in started:
+                led.setdefault(idx, set()).add(len(groups))
+                first[idx] = min(first[idx], len(groups))
+                groups.append([idx])
+        return groups
+
+    def detect(self, fgmask):
+        blobs = self._blobs(fgmask)
+        if not len(blobs):
+            return []
+        centres, radii = blobs[:, :2], blobs[:, 2]
+
+        # Blobs only ever group with blobs they are close to, so clusters of
+        # close blobs are grouped independently
+        i, j = self._pairs(centres, radii)
+        labels = self._clusters(len(blobs), i, j)
+        sizes = np.bincount(labels, minlength=len(blobs))
+        pair_counts = np.bincount(labels[i], minlength=len(blobs))
+
+        # A lone blob is seen once per level
+        keypoints = []
+        if self.levels >= self.min_repeatability:
+            keypoints = [cv.KeyPoint(x, y, 2 * radius) for x, y, radius in blobs[sizes[labels] == 1].tolist()]
+
+        clustered = np.flatnonzero(sizes[labels] > 1)
+        if not len(clustered):
+            return keypoints
+        clustered = clustered[np.argsort(labels[clustered], kind='stable')]
+        bounds = np.searchsorted(i, np.arange(len(blobs) + 1)).tolist()
+        partners = j.tolist()
+        radii = radii.tolist()
+        for cluster in np.split(clustered, np.flatnonzero(np.diff(labels[clustered])) + 1):
+            label = labels[cluster[0]]
+            if pair_counts[label] == sizes[label] * sizes[label]:
+                # Every blob is near every group, so from the second level on
+                # they all join the first one. Members sorted by radius
+                joined = [cluster[0]] + cluster.tolist() * (self.levels - 1)
+                groups = [sorted(joined, key=radii.__getitem__)] + [[idx] for idx in cluster[1:]]
+            else:
+                cluster = cluster.tolist()
+                neighbours = dict((idx, partners[bounds[idx]:bounds[idx + 1]]) for idx in cluster)
+                groups = self._group(cluster, neighbours, radii)
+
+            for group in groups:
+                if len(group) < self.min_repeatability:
+                    continue
+                x, y = centres[group].mean(axis=0)
+                keypoints.append(cv.KeyPoint(float(x), float(y), 2 * radii[group[len(group) // 2]]))
+        return keypoints
+
+
+BLOB_BACKENDS = ('simple', 'components')
+
+
+#
+# Cheap motion gate in front of the background model. Each analysed frame is
+# shrunk to a small grayscale copy and compared to the previous one; the score
+# is the fraction of pixels that changed by more than `pixel_threshold`. A
+# frame scoring below `threshold` can skip MOG2 and blob detection. Every
+# `refresh`th frame passes regardless so the background model keeps up with
+# slow lighting changes.
+#
+class MotionGate(object):
+
+    def __init__(self, threshold=constant.MOTION_GATE_THRESHOLD, pixel_threshold=constant.MOTION_GATE_PIXEL_DIFF,
+                 scale=constant.MOTION_GATE_SCALE, refresh=constant.MOTION_GATE_REFRESH):
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.scale = scale
+        self.refresh = refresh
+        self.score = 1.0
+        self._buffers = None
+        self._previous = None
+        self._diff = None
+        self._skipped = 0
+
+    # Grayscale, downscaled copy of the frame in whichever buffer does not
+    # hold the previous frame
+    def _shrink(self, frame):
+        if frame.ndim == 3:
+            frame = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+        size = (max(1, int(frame.shape[1] * self.scale)), max(1, int(frame.shape[0] * self.scale)))
+        if self._diff is None or self._diff.shape != (size[1], size[0]):
+            self._buffers = [np.empty((size[1], size[0]), dtype=np.uint8) for _ in range(2)]
+            self._diff = np.empty((size[1], size[0]), dtype=np.uint8)
+            self._previous = None
+
+        current = self._buffers[1] if self._previous is self._buffers[0] else self._buffers[0]
+        cv.resize(frame, size, dst=current, interpolation=cv.INTER_AREA)
+        return current
+
+    # Returns True when the frame needs the full detection path
+    def check(self, frame):
+        small = self._shrink(frame)
+        if self._previous is None:
+            self.score = 1.0
+        else:
+            cv.absdiff(small, self._previous, dst=self._diff)
+            cv.threshold(self._diff, self.pixel_threshold, 255, cv.THRESH_BINARY, dst=self._diff)
+            self.score = cv.countNonZero(self._diff) / float(self._diff.size)
+
+        # Compare the next frame against this one
+        self._previous = small
+
+        if self.score >= self.threshold or self._skipped + 1 >= self.refresh:
+            self._skipped = 0
+            return True
+        self._skipped += 1
+        return False
+
+
 class SnowDetector(object):
 
-    def __init__(self):
+    # roi:     ROI polygons in FrameSize coordinates
+    # origin:  (x, y) of the top left corner of incoming frames in FrameSize
+    #          coordinates. Non zero when the stream is cropped by the decoder
+    # channel: None to model the full BGR frame, 'gray' for grayscale or a
+    #          channel index (0-2) to model a single colour channel
+    # crop:    Only model the bounding box of the ROI polygons
+    # blob_backend: 'simple' for cv.SimpleBlobDetector or 'components' for
+    #          the connected components counter
+    # decay:   QParam decay per analysed frame, a number or a decay schedule
+    # checkpoint: .npz file the background model is periodically saved to and
+    #             warm started from. None disables checkpointing
+    # motion_gate: Skip MOG2 and blob detection on frames where nothing in the
+    #             ROI moved, see MotionGate
+    def __init__(self, roi=constant.ROI_POLYGONS, origin=(0, 0), channel=constant.DETECT_CHANNEL,
+                 crop=constant.DETECT_CROP, blob_backend=constant.BLOB_BACKEND, decay=constant.IMPULSE_DECAY,
+                 checkpoint=None, checkpoint_interval=constant.CHECKPOINT_INTERVAL_SECS,
+                 checkpoint_max_age=constant.CHECKPOINT_MAX_AGE_SECS, motion_gate=constant.MOTION_GATE):
+        if channel not in (None, 'gray', 0, 1, 2):
+            raise ValueError("Unknown detector channel: %r" % (channel,))
+        if blob_backend not in BLOB_BACKENDS:
+            raise ValueError("Unknown blob backend: %s" % blob_backend)
+        self._roi_mask = RoiMask(roi, origin=origin)
+        self._channel = channel
+        self._crop = crop
         self._background_subtractor = cv.createBackgroundSubtractorMOG2(detectShadows=False)
         params = self._get_blob_detector_params()
-        self._blob_detector = cv.SimpleBlobDetector_create(params)
-        self._q_param = QParam()
+        if blob_backend == 'components':
+            self._blob_detector = ComponentBlobDetector.from_params(params)
+        else:
+            self._blob_detector = cv.SimpleBlobDetector_create(params)
+        self._q_param = QParam(decay=decay)
         self._debug_mask = None
         self._debug_keypoints = None
+        self._motion_gate = MotionGate() if motion_gate else None
         self.detect_counter = 0
+        self.gated_counter = 0      # Frames the motion gate let skip the full path
+
+        self._checkpoint = checkpoint
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoint_max_age = checkpoint_max_age
+        self._last_checkpoint = time.monotonic()
+        self._pending_restore = self.load_checkpoint(checkpoint) if checkpoint else None
 
     @staticmethod
     def _get_blob_detector_params():
@@ -68,45 +569,139 @@ class SnowDetector(object):
 
         return params
 
-    @staticmethod
-    def _mask_out_areas(frame):
-
-        # Define mask same size as frame, fill with 0s
-        mask = np.zeros(frame.shape, dtype=np.uint8)
-
-        # MARK: Define polygons of interest.
-        # poly_region1 = np.array([[(0, 84), (260, 130), (260, 170), (0,274)]], dtype=np.int32)
-        # poly_region2 = np.array([[(440, 0), (650, 0), (650, 250), (510, 250)]], dtype=np.int32)
+    def _mask_out_areas(self, frame):
+        if self._crop:
+            return self._roi_mask.apply_cropped(frame)
+        return self._roi_mask.apply(frame)
 
-        poly_region1 = np.array([[(0, 42), (130, 65), (130, 85), (0,137)]], dtype=np.int32)
-        poly_region2 = np.array([[(220, 0), (325, 0), (325, 125), (255, 125)]], dtype=np.int32)
+    def _select_channel(self, frame):
+        if self._channel is None or frame.ndim == 2:
+            return frame
+        if self._channel == 'gray':
+            return cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+        return cv.extractChannel(frame, self._channel)
 
-        # fill the  so it doesn't get wiped out when the mask is applied
-        channel_count = frame.shape[2]
-        ignore_mask_color = (255,) * channel_count
-        cv.fillPoly(mask, poly_region1, ignore_mask_color)
-        cv.fillPoly(mask, poly_region2, ignore_mask_color)
+    # Crop (if enabled) and reduce to the modelled channel. Returns the frame
+    # and the offset of its top left corner in the incoming frame
+    def _prepare(self, frame):
+        # Crop first so the channel conversion only touches the ROI
+        offset = (0, 0)
+        if self._crop:
+            frame = self._roi_mask.crop(frame)
+            offset = self._roi_mask.rect[:2]
 
-        # apply the mask
-        masked_frame = cv.bitwise_and(frame, mask)
-
-        return masked_frame
-
-    def detect(self, frame):
-        frame = self._mask_out_areas(frame)
+        return self._select_channel(frame), offset
 
+    def _foreground(self, frame):
         fgmask = self._background_subtractor.apply(frame, learningRate=.023)
         fgmask[fgmask < 255] = 0
 
         if constant.DEBUG is True:
             self._debug_mask = fgmask
+        return fgmask
 
+    def _find_blobs(self, fgmask, offset=(0, 0)):
         keypoints = self._blob_detector.detect(fgmask)
 
+        # Map keypoints from the cropped frame back to full frame coordinates
+        if offset != (0, 0):
+            for keypoint in keypoints:
+                keypoint.pt = (keypoint.pt[0] + offset[0], keypoint.pt[1] + offset[1])
+        return keypoints
+
+    # Settings that change what the background model sees. A checkpoint taken
+    # with different settings is not restored
+    def _model_config(self):
+        return json.dumps({'channel': self._channel, 'crop': bool(self._crop),
+                           'roi': [polygon.tolist() for polygon in self._roi_mask.polygons]}, sort_keys=True)
+
+    # Atomically write the learned background image and QParam value to `path`
+    def save_checkpoint(self, path=None):
+        path = path or self._checkpoint
+        background = self._background_subtractor.getBackgroundImage()
+        if background is None:
+            # Nothing learned yet
+            return False
+
+        self._last_checkpoint = time.monotonic()
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as checkpoint_file:
+                np.savez_compressed(checkpoint_file, background=background, q_value=self._q_param.value,
+                                    saved_at=time.time(), config=self._model_config())
+            os.replace(tmp_path, path)
+        except (IOError, OSError) as e:
+            logger.warning("Could not write background checkpoint %s: %s", path, e)
+            return False
+        return True
+
+    # Read a checkpoint, returns None if it is missing, stale or was taken with
+    # different detector settings
+    def load_checkpoint(self, path):
+        try:
+            with np.load(path) as checkpoint:
+                saved_at = float(checkpoint['saved_at'])
+                config = str(checkpoint['config'])
+                state = {'background': checkpoint['background'], 'q_value': int(checkpoint['q_value'])}
+        except (IOError, OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            logger.info("No usable background checkpoint at %s: %s", path, e)
+            return None
+
+        age = time.time() - saved_at
+        if age > self._checkpoint_max_age:
+            logger.info("Ignoring background checkpoint %s, %ds old", path, age)
+            return None
+        if config != self._model_config():
+            logger.info("Ignoring background checkpoint %s, taken with different detector settings", path)
+            return None
+        return state
+
+    # Seed MOG2 with the checkpointed background. A learning rate of 1
+    # reinitialises the model from this single image
+    def _restore(self, frame):
+        state, self._pending_restore = self._pending_restore, None
+        if state['background'].shape != frame.shape:
+            logger.info("Ignoring background checkpoint, frame shape %s != %s",
+                        frame.shape, state['background'].shape)
+            return
+        self._background_subtractor.apply(state['background'], learningRate=1)
+        self._q_param.value = state['q_value']
+        logger.info("Warm started background model from %s", self._checkpoint)
+
+    # QParam value above which the current frame counts as snow
+    @property
+    def threshold(self):
+        return self._q_param.threshold
+
+    # Only the ROI bounding box decides whether anything moved
+    def _moved(self, frame):
+        return self._motion_gate.check(frame if self._crop else self._roi_mask.crop(frame))
+
+    def detect(self, frame):
+        frame, offset = self._prepare(frame)
+
+        if self._motion_gate is not None and not self._moved(frame):
+            # Static scene, no blobs. QParam still decays as usual
+            keypoints = []
+            self.gated_counter += 1
+            metrics.FRAMES_GATED.inc()
+        else:
+            frame = self._mask_out_areas(frame)
+
+            if self._pending_restore is not None:
+                self._restore(frame)
+
+            fgmask = self._foreground(frame)
+
+            keypoints = self._find_blobs(fgmask, offset)
+
         self._debug_keypoints = keypoints
 
         self._q_param.update(keypoints)
 
         self.detect_counter += 1
-        return self._q_param.value
 
+        if self._checkpoint and time.monotonic() - self._last_checkpoint >= self._checkpoint_interval:
+            self.save_checkpoint()
+
+        return self._q_param.value
@@ -5,3 +5,8 @@ class StreamError(Exception):
             self.message = "Stream Error: " + err_obj.__repr__()
         if message:
             self.message = "Stream Error: " + message
+
+
+# Raised when no data arrives from a stream within its read timeout
+class StreamTimeout(StreamError):
+    pass
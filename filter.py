@@ -1,11 +1,80 @@
+import time
 import cv2 as cv
+import numpy as np
+import constant
+import metrics
 
 
-def resize(stream, scale=1):
-    for frame in stream:
-        yield cv.resize(frame, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+#
+# Fused resize + blur into preallocated buffers.
+# The frame is shrunk into a scratch buffer and blurred straight into the
+# next frame of a small ring, so nothing is allocated per frame. A returned
+# frame stays valid until pool_size more frames have been processed.
+# Without a pool every frame gets its own buffer, for frames handed to another
+# thread that may hold on to them for any number of frames.
+#
+class Preprocessor(object):
 
+    # scale:       Resize factor, 1 to only blur (e.g. decoder scaled streams)
+    # kernel_size: Gaussian kernel size, 1 or less to only resize
+    # pool_size:   Frames in the output ring. Must cover every frame a consumer
+    #              holds on to, None to allocate a new frame every time
+    def __init__(self, scale=constant.PREPROCESS_SCALE, kernel_size=constant.PREPROCESS_KERNEL,
+                 pool_size=constant.FRAME_POOL_SIZE):
+        if pool_size is not None and pool_size < 1:
+            raise ValueError("Preprocessor needs at least one output frame")
+        self.scale = scale
+        self.kernel_size = kernel_size
+        self.pool_size = pool_size
+        self._resized = None
+        self._ring = None
+        self._shape = None
+        self._idx = 0
 
-def blur(stream, kernel_size=3):
-    for frame in stream:
-        yield cv.GaussianBlur(frame, (kernel_size, kernel_size), 0)
+    # Output (width, height), rounded the same way cv.resize rounds fx/fy
+    def output_size(self, shape):
+        return max(1, int(round(shape[1] * self.scale))), max(1, int(round(shape[0] * self.scale)))
+
+    def _allocate(self, shape):
+        width, height = self.output_size(shape)
+        out_shape = (height, width) + tuple(shape[2:])
+        if self._shape != out_shape:
+            self._shape = out_shape
+            self._resized = np.empty(out_shape, dtype=np.uint8)
+            if self.pool_size is not None:
+                self._ring = [np.empty(out_shape, dtype=np.uint8) for _ in range(self.pool_size)]
+            self._idx = 0
+        return width, height
+
+    def __call__(self, frame):
+        start = time.perf_counter()
+        size = self._allocate(frame.shape)
+
+        src = frame
+        if self.scale != 1:
+            cv.resize(frame, size, dst=self._resized, interpolation=cv.INTER_AREA)
+            src = self._resized
+
+        if self.pool_size is None:
+            dst = np.empty(self._shape, dtype=np.uint8)
+        else:
+            dst = self._ring[self._idx]
+            self._idx = (self._idx + 1) % self.pool_size
+        if self.kernel_size > 1:
+            cv.GaussianBlur(src, (self.kernel_size, self.kernel_size), 0, dst=dst)
+        else:
+            np.copyto(dst, src)
+
+        metrics.STAGE_LATENCY.observe(time.perf_counter() - start, 'preprocess')
+        return dst
+
+    # Preprocess every hop'th frame of a stream, the frames in between are
+    # dropped without being touched
+    def frames(self, stream, hop=1):
+        skipped = 0
+        for frame in stream:
+            skipped += 1
+            if skipped < hop:
+                continue
+            skipped = 0
+            yield self(frame)
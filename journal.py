@@ -0,0 +1,191 @@
+import bisect
+import os
+import threading
+import time
+
+import numpy as np
+
+import constant
+
+# Record kinds
+FRAME = 1           # value: QParam value, count: keypoints
+SECOND = 2          # value: snow seconds in the window, count: snow events in the second, refractory: timer
+NOTIFICATION = 3    # value: snapshot confidence (-1 if unknown), count: event window second
+
+# Flag bits
+SNOW = 1            # FRAME counted as snow / SECOND had snow events
+SNOWING = 2         # SECOND closed with the event window deciding it is snowing
+RECORDING = 4       # Written while analysing a recording, time is when the frame was recorded
+
+# Fixed width little endian records, so a journal file is a flat array that
+# can be memory mapped as is
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('kind', 'u1'), ('flags', 'u1'), ('count', '<u4'),
+                         ('refractory', '<u4'), ('value', '<f4')])
+
+_EMPTY = np.zeros(0, dtype=RECORD_DTYPE)
+
+
+#
+# Read access to a journal file. Records are memory mapped and only the parts
+# that are touched get paged in. Wall clock timestamps are appended in order,
+# so time ranges are found by bisection without reading the whole file.
+# Recording times jump back whenever another recording (or an earlier start)
+# is analysed, so ranges of a recording journal are found with a full scan.
+#
+class JournalReader(object):
+
+    def __init__(self, path):
+        count = os.path.getsize(path) // RECORD_DTYPE.itemsize if os.path.exists(path) else 0
+        # A crash mid write can leave a partial record at the end, ignore it
+        self.records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(count,)) if count else _EMPTY
+        # A journal holds either live or recording records, as its first one
+        self.recording = bool(count and self.records[0]['flags'] & RECORDING)
+
+    def __len__(self):
+        return len(self.records)
+
+    # Records with start <= time < end, optionally of one kind
+    def range(self, start=None, end=None, kind=None):
+        if self.recording:
+            records = self.records
+            if start is not None:
+                records = records[records['time'] >= start]
+            if end is not None:
+                records = records[records['time'] < end]
+        else:
+            # bisect probes the memory map directly instead of copying the time column
+            times = self.records['time']
+            lo = 0 if start is None else bisect.bisect_left(times, start)
+            hi = len(times) if end is None else bisect.bisect_left(times, end)
+            records = self.records[lo:hi]
+        if kind is not None:
+            records = records[records['kind'] == kind]
+        return records
+
+    def frames(self, start=None, end=None):
+        return self.range(start, end, FRAME)
+
+    def seconds(self, start=None, end=None):
+        return self.range(start, end, SECOND)
+
+    def notifications(self, start=None, end=None):
+        return self.range(start, end, NOTIFICATION)
+
+    # Last `count` records of `kind`, scanning back from the end in growing
+    # blocks so only the tail of the file is read
+    def tail(self, kind, count, block=4096):
+        found = []
+        total = 0
+        end = len(self.records)
+        while end > 0 and total < count:
+            start = max(0, end - block)
+            chunk = self.records[start:end]
+            chunk = chunk[chunk['kind'] == kind]
+            found.insert(0, chunk)
+            total += len(chunk)
+            end = start
+            block *= 2
+        if not found:
+            return _EMPTY
+        return np.concatenate(found)[-count:]
+
+
+#
+# Append only event journal. Frame records are buffered and written in
+# batches, window seconds and notifications flush the buffer so at most a
+# second of frame records is lost on a crash.
+#
+class EventJournal(object):
+
+    # clock:     Unix time of the frame being analysed, the wall clock for the
+    #            live feed or the recording time of a video file
+    # recording: Records come from a video file, they are flagged RECORDING so
+    #            they are never restored into the live event window. Live and
+    #            recording records never share a file, live ones have to stay
+    #            in time order
+    def __init__(self, path, clock=time.time, buffer_size=constant.JOURNAL_BUFFER_RECORDS, recording=False):
+        existing = JournalReader(path)
+        if len(existing) and existing.recording != recording:
+            raise ValueError("%s is a %s journal, use another one for %s records"
+                             % (path, 'recording' if existing.recording else 'live',
+                                'recording' if recording else 'live'))
+
+        self.path = path
+        self.recording = recording
+        self._flags = RECORDING if recording else 0
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buffer = np.zeros(buffer_size, dtype=RECORD_DTYPE)
+        self._buffered = 0
+
+        self._file = open(path, 'ab')
+        size = os.path.getsize(path)
+        if size % RECORD_DTYPE.itemsize:
+            # Drop a partial record so new records stay aligned
+            self._file.truncate(size - size % RECORD_DTYPE.itemsize)
+
+    def now(self):
+        return self._clock()
+
+    def _append(self, kind, flags=0, count=0, refractory=0, value=0, flush=False):
+        with self._lock:
+            self._buffer[self._buffered] = (self._clock(), kind, flags | self._flags, count, refractory, value)
+            self._buffered += 1
+            if flush or self._buffered == len(self._buffer):
+                self._flush()
+
+    def _flush(self):
+        if self._buffered:
+            self._file.write(self._buffer[:self._buffered].tobytes())
+            self._file.flush()
+            self._buffered = 0
+
+    def frame(self, q_value, keypoints, snow):
+        self._append(FRAME, SNOW if snow else 0, keypoints, 0, q_value)
+
+    def second(self, count, snow_seconds, refractory, snowing):
+        flags = (SNOW if count else 0) | (SNOWING if snowing else 0)
+        self._append(SECOND, flags, count, refractory, snow_seconds, flush=True)
+
+    def notification(self, second, confidence=None):
+        self._append(NOTIFICATION, 0, second, 0, -1 if confidence is None else confidence, flush=True)
+
+    # Last `count` records of `kind`, including anything still buffered
+    def tail(self, kind, count):
+        with self._lock:
+            self._flush()
+        return JournalReader(self.path).tail(kind, count)
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    import datetime
+
+    def parse_time(value):
+        return time.mktime(datetime.datetime.strptime(value, '%Y-%m-%d %H:%M').timetuple())
+
+    parser = argparse.ArgumentParser(description='Summarise an event journal')
+    parser.add_argument('journal', type=str)
+    parser.add_argument('--start', type=parse_time, default=None, help="Local time 'YYYY-MM-DD HH:MM'")
+    parser.add_argument('--end', type=parse_time, default=None, help="Local time 'YYYY-MM-DD HH:MM'")
+    args = parser.parse_args()
+
+    reader = JournalReader(args.journal)
+    frames = reader.frames(args.start, args.end)
+    seconds = reader.seconds(args.start, args.end)
+    print("%d frames (%d snow), %d seconds (%d snowing)"
+          % (len(frames), np.count_nonzero(frames['flags'] & SNOW),
+             len(seconds), np.count_nonzero(seconds['flags'] & SNOWING)))
+    for record in reader.notifications(args.start, args.end):
+        print("notification %s" % datetime.datetime.fromtimestamp(record['time']).strftime('%Y-%m-%d %H:%M:%S'))
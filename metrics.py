@@ -0,0 +1,225 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import constant
+
+# Latency buckets in seconds, sub millisecond up to a few seconds
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+#
+# Minimal Prometheus style metrics.
+# Label values are passed positionally in labelnames order, e.g.
+# STAGE_LATENCY.observe(.01, 'detect').
+#
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError("%s expects labels %s" % (self.name, self.labelnames))
+        return tuple(labelvalues)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        _Metric.__init__(self, name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, *labelvalues):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labelvalues):
+        return self._values.get(self._key(labelvalues), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, key), _format_value(value))
+                for key, value in items]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        _Metric.__init__(self, name, documentation, labelnames)
+        self._values = {}
+        self._functions = {}
+
+    def set(self, value, *labelvalues):
+        self._values[self._key(labelvalues)] = value
+
+    # Evaluate `function` at scrape time instead of storing a value
+    def set_function(self, function, *labelvalues):
+        with self._lock:
+            self._functions[self._key(labelvalues)] = function
+
+    def value(self, *labelvalues):
+        key = self._key(labelvalues)
+        if key in self._functions:
+            return self._functions[key]()
+        return self._values.get(key, 0)
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+            values.update((key, function()) for key, function in self._functions.items())
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, key), _format_value(value))
+                for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}   # key -> [bucket counts..., sum, count]
+
+    def observe(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 3)
+            state[idx] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def count(self, *labelvalues):
+        state = self._values.get(self._key(labelvalues))
+        return state[-1] if state else 0
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state[:-2]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append('%s_bucket%s %d' % (self.name, labels, cumulative))
+            labels = _format_labels(self.labelnames, key)
+            lines.append('%s_sum%s %s' % (self.name, labels, _format_value(state[-2])))
+            lines.append('%s_count%s %d' % (self.name, labels, state[-1]))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    # Prometheus text exposition format
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+FRAMES_DECODED = REGISTRY.counter('snowtify_frames_decoded_total', 'Frames read from the video source')
+FRAMES_ANALYSED = REGISTRY.counter('snowtify_frames_analysed_total', 'Frames run through the snow detector')
+FRAMES_GATED = REGISTRY.counter('snowtify_frames_gated_total',
+                                'Analysed frames the motion gate let skip the background model')
+FRAMES_DROPPED = REGISTRY.counter('snowtify_frames_dropped_total', 'Frames dropped by full pipeline queues',
+                                  ('stage',))
+CAMERA_FRAMES_DROPPED = REGISTRY.counter('snowtify_camera_frames_dropped_total',
+                                         'Frames a camera dropped because its analysis worker was behind',
+                                         ('camera',))
+STAGE_LATENCY = REGISTRY.histogram('snowtify_stage_latency_seconds', 'Per frame latency of each processing stage',
+                                   ('stage',))
+QUEUE_DEPTH = REGISTRY.gauge('snowtify_queue_depth', 'Frames waiting in each pipeline queue', ('stage',))
+QPARAM = REGISTRY.gauge('snowtify_qparam', 'Current QParam (snow confidence) value')
+EVENT_WINDOW_SNOW = REGISTRY.gauge('snowtify_event_window_snow_seconds', 'Seconds in the event window with snow')
+EVENT_WINDOW_FILL = REGISTRY.gauge('snowtify_event_window_fill_ratio', 'Fraction of the event window with snow')
+REFRACTORY = REGISTRY.gauge('snowtify_refractory_seconds', 'Seconds of no snow since the last notification')
+FFMPEG_RESTARTS = REGISTRY.counter('snowtify_ffmpeg_restarts_total', 'ffmpeg restarts', ('reason',))
+NOTIFICATIONS = REGISTRY.counter('snowtify_notifications_total', 'Notifications sent per channel',
+                                 ('channel', 'result'))
+NOTIFICATION_LATENCY = REGISTRY.histogram('snowtify_notification_send_seconds',
+                                          'Time to send a notification to a channel, including retries',
+                                          ('channel',))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line each
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# Serve the registry at http://addr:port/metrics on a daemon thread
+def start_http_server(port=constant.METRICS_PORT, addr='127.0.0.1', registry=REGISTRY):
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+    server = _ThreadingHTTPServer((addr, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
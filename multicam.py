@@ -0,0 +1,275 @@
+import json
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+
+import constant
+import exceptions
+import metrics
+from detect import SnowDetector, decay_schedule, single_thread_opencv
+from filter import Preprocessor
+from stream import ArmoryCamStream
+from snowtify import EventWindow, NotificationThread, Notification, SnapshotBuffer
+from journal import EventJournal
+
+logger = logging.getLogger(__name__)
+
+
+#
+# One camera from the cameras config file. Only name and url are required,
+# everything else falls back to the single camera defaults in constant.
+#
+class CameraConfig(object):
+
+    def __init__(self, name, url, roi=None, decay=constant.IMPULSE_DECAY, snow_threshold=None,
+                 window=constant.NOTIFY_EVENT_WINDOW_SECS, notify_threshold=constant.NOTIFY_THRESHOLD,
+                 not_snowing_threshold=constant.NOT_SNOWING_THRESHOLD, refractory=constant.NOTIF_REFRACTORY_SECS,
+                 analysis_fps=constant.ANALYSIS_FPS, checkpoint=None, decay_schedule=None, journal=None):
+        self.name = name
+        self.url = url
+        self.roi = [[(int(x), int(y)) for x, y in polygon] for polygon in roi] if roi else constant.ROI_POLYGONS
+        self.decay = decay
+        # 'adaptive' or {hour: decay}, see detect.decay_schedule
+        self.decay_schedule = decay_schedule
+        # QParam value above which an analysed frame counts as snow. None
+        # tracks the decay (schedule)
+        self.snow_threshold = snow_threshold
+        self.window = window
+        self.notify_threshold = notify_threshold
+        self.not_snowing_threshold = not_snowing_threshold
+        self.refractory = refractory
+        self.analysis_fps = analysis_fps
+        # Background model checkpoint file, see SnowDetector
+        self.checkpoint = checkpoint
+        # Event journal file, see journal.EventJournal
+        self.journal = journal
+
+
+# Load a JSON list of camera definitions
+def load_cameras(path):
+    with open(path) as cameras_file:
+        definitions = json.load(cameras_file)
+
+    cameras = [CameraConfig(**definition) for definition in definitions]
+    names = [camera.name for camera in cameras]
+    if not cameras or len(set(names)) != len(names):
+        raise ValueError("Cameras config %s needs at least one camera and unique names" % path)
+    return cameras
+
+
+#
+# Analysis worker process. Owns the SnowDetector (and MOG2 model) of every
+# camera pinned to it, so per camera state never crosses processes. Frames
+# come in as (camera name, frame) and results go out as
+# (camera name, QParam value, keypoint count, snow?, JPEG snapshot or None).
+#
+def _analysis_worker(cameras, frame_queue, result_queue):
+    single_thread_opencv()
+
+    detectors = dict((camera.name, SnowDetector(roi=camera.roi,
+                                                decay=decay_schedule(camera.decay_schedule, camera.decay),
+                                                checkpoint=camera.checkpoint)) for camera in cameras)
+    snapshots = dict((camera.name, SnapshotBuffer(window=camera.window)) for camera in cameras)
+    thresholds = dict((camera.name, camera.snow_threshold) for camera in cameras)
+    # ffmpeg already scaled the frames, only blur them. Snapshots copy the
+    # frame, so two output frames per camera are enough
+    preprocessors = dict((camera.name, Preprocessor(scale=1, pool_size=2)) for camera in cameras)
+
+    while True:
+        item = frame_queue.get()
+        if item is None:
+            break
+
+        name, frame = item
+        frame = preprocessors[name](frame)
+        detector = detectors[name]
+        snow_confidence = detector.detect(frame)
+        threshold = thresholds[name] if thresholds[name] is not None else detector.threshold
+        snow = snow_confidence > threshold
+
+        # Only encode a snapshot when it could end up attached to a notification
+        jpeg = None
+        if snapshots[name].log_frame(frame, snow_confidence) and snow:
+            jpeg = snapshots[name].encode()
+
+        result_queue.put((name, snow_confidence, len(detector._debug_keypoints), snow, jpeg))
+
+    for camera in cameras:
+        if camera.checkpoint:
+            detectors[camera.name].save_checkpoint()
+
+
+#
+# Reads one camera on its own thread and forwards analysis frames to the
+# worker the camera is pinned to. ffmpeg already scales and drops frames to
+# the analysis rate, and a full worker queue drops the frame rather than
+# stalling the pipe.
+#
+class CameraReader(threading.Thread):
+
+    def __init__(self, camera, frame_queue, stopped):
+        threading.Thread.__init__(self, name='reader-%s' % camera.name)
+        self.daemon = True
+        self.camera = camera
+        self._frame_queue = frame_queue
+        self._stopped = stopped
+        self._stream = None
+
+    def run(self):
+        try:
+            self._stream = ArmoryCamStream(scaled=True, analysis_fps=self.camera.analysis_fps, url=self.camera.url)
+            with self._stream:
+                for frame in self._stream:
+                    if self._stopped.is_set():
+                        break
+                    try:
+                        # Copy, the stream reuses its frame buffers
+                        self._frame_queue.put_nowait((self.camera.name, frame.copy()))
+                    except queue.Full:
+                        metrics.CAMERA_FRAMES_DROPPED.inc(1, self.camera.name)
+        except exceptions.StreamError as e:
+            if not self._stopped.is_set():
+                logger.error("camera=%s %s", self.camera.name, e.message)
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+
+
+class MultiCamSnowtification(object):
+
+    def __init__(self, cameras, workers=None, channels=None):
+        self.cameras = dict((camera.name, camera) for camera in cameras)
+        workers = min(workers or multiprocessing.cpu_count(), len(cameras))
+
+        self._stopped = threading.Event()
+        self._result_queue = multiprocessing.Queue()
+        self._frame_queues = [multiprocessing.Queue(constant.MULTICAM_QUEUE_SIZE) for _ in range(workers)]
+
+        # Pin cameras to workers round robin
+        self._workers = []
+        self._pinned = {}        # Worker name -> names of the cameras it analyses
+        self._readers = []
+        for idx, frame_queue in enumerate(self._frame_queues):
+            pinned = cameras[idx::workers]
+            self._workers.append(multiprocessing.Process(target=_analysis_worker, name='analysis-%d' % idx,
+                                                         args=(pinned, frame_queue, self._result_queue)))
+            self._pinned[self._workers[-1].name] = [camera.name for camera in pinned]
+            self._readers.extend(CameraReader(camera, frame_queue, self._stopped) for camera in pinned)
+
+        # One notification dispatcher shared by every camera
+        self._notif_queue = queue.Queue(len(cameras))
+        self._notif_stopped = threading.Event()
+        self._notif_thread = NotificationThread(self._notif_stopped, channels=channels, notif_queue=self._notif_queue)
+
+        self._snapshots = {}     # Camera name -> (monotonic time, JPEG, confidence) of its latest peak
+        self._journals = dict((camera.name, EventJournal(camera.journal)) for camera in cameras if camera.journal)
+        self._windows = dict(
+            (camera.name, EventWindow(refrac_init=camera.refractory, window=camera.window,
+                                      notify_threshold=camera.notify_threshold,
+                                      no_snow_threshold=camera.not_snowing_threshold,
+                                      refractory_secs=camera.refractory,
+                                      notify=self._notifier(camera.name),
+                                      journal=self._journals.get(camera.name)))
+            for camera in cameras)
+
+    def _notifier(self, name):
+        def notify(second=None):
+            logger.warning("SEND THE SNOWTIFICATION! camera=%s second=%s", name, second)
+            # A snapshot older than the window is from an earlier snow episode
+            taken, image, confidence = self._snapshots.get(name, (None, None, None))
+            if taken is not None and time.monotonic() - taken > self.cameras[name].window:
+                del self._snapshots[name]
+                image = confidence = None
+            try:
+                self._notif_queue.put_nowait(Notification(image=image, confidence=confidence, camera=name))
+            except queue.Full:
+                logger.info("Notification already pending camera=%s", name)
+            return confidence
+        return notify
+
+    # metrics_port: Serve Prometheus metrics on this local port once the
+    #               workers are running
+    # Returns False if it stopped because an analysis worker died
+    def run(self, metrics_port=None):
+        # Fork the workers before any threads exist, the metrics server's included
+        for worker in self._workers:
+            worker.start()
+        if metrics_port:
+            metrics.start_http_server(port=metrics_port)
+        self._notif_thread.start()
+        for reader in self._readers:
+            reader.start()
+
+        try:
+            while any(reader.is_alive() for reader in self._readers):
+                # Its cameras would silently stop being analysed
+                dead = [worker for worker in self._workers if not worker.is_alive()]
+                if dead:
+                    for worker in dead:
+                        logger.error("%s cameras=%s exited with code %s, stopping", worker.name,
+                                     ",".join(self._pinned[worker.name]), worker.exitcode)
+                    return False
+
+                try:
+                    name, snow_confidence, keypoints, snow, jpeg = self._result_queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+
+                metrics.FRAMES_ANALYSED.inc()
+                if jpeg is not None:
+                    self._snapshots[name] = (time.monotonic(), jpeg, snow_confidence)
+
+                if name in self._journals:
+                    self._journals[name].frame(snow_confidence, keypoints, snow)
+
+                window = self._windows[name]
+                if snow:
+                    window.log_snow_event()
+                else:
+                    window.tick()
+            return True
+        finally:
+            self.stop()
+
+    def stop(self):
+        self._stopped.set()
+        for reader in self._readers:
+            reader.close()
+        for frame_queue in self._frame_queues:
+            try:
+                frame_queue.put(None, timeout=1)
+            except queue.Full:
+                # Worker is stuck, it gets terminated below
+                pass
+        for worker in self._workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+        self._notif_thread.stop()
+        for journal in self._journals.values():
+            journal.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Watch several cameras with a shared pool of detector workers')
+    parser.add_argument('cameras', type=str, help='JSON file of camera definitions')
+    parser.add_argument('--workers', '-j', type=int, default=None, help='Analysis processes (default: all cores)')
+    parser.add_argument('--metrics-port', type=int, default=constant.METRICS_PORT,
+                        help='Serve Prometheus metrics on this local port (0 to disable)')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level,
+                        format='%(asctime)s level=%(levelname)s logger=%(name)s %(message)s')
+
+    try:
+        snowtification = MultiCamSnowtification(load_cameras(args.cameras), workers=args.workers)
+        if not snowtification.run(metrics_port=args.metrics_port):
+            raise SystemExit(1)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,186 @@
+import collections
+import logging
+import threading
+import time
+
+import constant
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Queue overflow policies
+DROP_OLDEST = 'drop-oldest'    # Drop the oldest queued frame to make room for the new one
+LATEST_ONLY = 'latest-only'    # Only ever hold the most recent frame
+
+POLICIES = (DROP_OLDEST, LATEST_ONLY)
+
+
+#
+# Bounded frame queue that never blocks the producer.
+# When full, the oldest frame is thrown away and counted as dropped so the
+# consumer always works on the freshest frames available.
+#
+class FrameQueue(object):
+
+    # name: Stage name drops are reported under
+    def __init__(self, maxsize=constant.PIPELINE_QUEUE_SIZE, policy=DROP_OLDEST, name=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy: %s" % policy)
+        if policy == LATEST_ONLY:
+            maxsize = 1
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.name = name
+        self.dropped = 0
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._error = None
+
+    def put(self, item):
+        with self._cond:
+            if self._closed:
+                return
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+                if self.name is not None:
+                    metrics.FRAMES_DROPPED.inc(1, self.name)
+            self._items.append(item)
+            self._cond.notify()
+
+    # Block until a frame is available. Raises StopIteration once the queue is
+    # closed and drained, or re-raises the error the producer closed it with.
+    def get(self):
+        with self._cond:
+            while not self._items and not self._closed:
+                self._cond.wait()
+            if self._items:
+                return self._items.popleft()
+            if self._error is not None:
+                raise self._error
+            raise StopIteration
+
+    # Mark end of stream. Consumers drain what is left, then stop (or see error)
+    def close(self, error=None):
+        with self._cond:
+            self._closed = True
+            self._error = error
+            self._cond.notify_all()
+
+    def depth(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.get()
+
+    next = __next__
+
+
+#
+# A pipeline stage: pulls from its source on a dedicated thread, runs the
+# items through `transform` and pushes the results onto its output queue.
+# `transform` takes an iterable and returns an iterable, which lets the
+# generators in filter.py be used as stages unchanged.
+#
+class Stage(threading.Thread):
+
+    def __init__(self, name, source, transform, maxsize=constant.PIPELINE_QUEUE_SIZE, policy=DROP_OLDEST):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.source = source
+        self.transform = transform
+        self.output = FrameQueue(maxsize=maxsize, policy=policy, name=name)
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            for item in self.transform(self.source):
+                if self.stopped.is_set():
+                    break
+                self.output.put(item)
+        except Exception as e:
+            self.output.close(error=e)
+        else:
+            self.output.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.output.close()
+
+
+#
+# Threaded decode -> filter -> consumer pipeline.
+# The stream is read on its own thread so a slow consumer never stalls the
+# ffmpeg pipe; frames pile up in bounded queues and the oldest are dropped.
+#
+# Note: a producer never waits on a full queue, so it can lap any ring of
+# reused frames (FramePool, Preprocessor) while the consumer still holds one.
+# Consume ring frames within the stage that reads them and only queue frames
+# the producer never touches again, e.g. from Preprocessor(pool_size=None).
+#
+class Pipeline(object):
+
+    def __init__(self, stream, maxsize=constant.PIPELINE_QUEUE_SIZE, policy=DROP_OLDEST):
+        self.maxsize = maxsize
+        self.policy = policy
+        self._stages = []
+        self.add_stage('decode', lambda source: source, source=stream)
+
+    def add_stage(self, name, transform, source=None):
+        if source is None:
+            source = self._stages[-1].output
+        self._stages.append(Stage(name, source, transform, maxsize=self.maxsize, policy=self.policy))
+        return self
+
+    def start(self):
+        for stage in self._stages:
+            metrics.QUEUE_DEPTH.set_function(stage.output.depth, stage.name)
+            stage.start()
+        return self
+
+    def stop(self):
+        for stage in self._stages:
+            stage.stop()
+
+    # Per stage output queue depth and number of frames dropped
+    def stats(self):
+        return collections.OrderedDict(
+            (stage.name, {'depth': stage.output.depth(), 'dropped': stage.output.dropped})
+            for stage in self._stages
+        )
+
+    @property
+    def dropped(self):
+        return sum(stage.output.dropped for stage in self._stages)
+
+    def __iter__(self):
+        return iter(self._stages[-1].output)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+# Log pipeline stats at most once every `interval` seconds
+class StatsReporter(object):
+
+    def __init__(self, pipeline, interval=constant.PIPELINE_STATS_SECS):
+        self._pipeline = pipeline
+        self._interval = interval
+        self._last_report = time.time()
+
+    def tick(self):
+        now = time.time()
+        if now - self._last_report < self._interval:
+            return
+        self._last_report = now
+        stats = self._pipeline.stats()
+        logger.info("pipeline %s", " ".join("%s_depth=%d %s_dropped=%d" % (name, s['depth'], name, s['dropped'])
+                                             for name, s in stats.items()))
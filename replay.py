@@ -0,0 +1,192 @@
+import array
+import itertools
+import time
+
+import numpy as np
+
+import constant
+
+# One row per swept parameter combination
+COMBO_DTYPE = np.dtype([('decay', np.float64), ('threshold', np.float64), ('notify_threshold', np.float64),
+                        ('not_snowing_threshold', np.float64), ('refractory', np.int64)])
+
+
+#
+# Records the raw keypoint count of every analysed frame with the event window
+# clock, so detection only has to run once per video and the QParam and
+# EventWindow settings can be swept afterwards.
+#
+class CountRecorder(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._times = array.array('d')
+        self._keypoints = array.array('I')
+
+    def record(self, timestamp, keypoints):
+        self._times.append(timestamp)
+        self._keypoints.append(keypoints)
+
+    def save(self):
+        np.savez_compressed(self.path, time=np.frombuffer(self._times, dtype=np.float64),
+                            keypoints=np.frombuffer(self._keypoints, dtype=np.uint32))
+
+
+# Load (timestamps, keypoint counts) from a CountRecorder file, or for one
+# file of a batch.py output using the frame numbers as the clock
+def load_counts(path, file_idx=0, fps=constant.SOURCE_FPS):
+    with np.load(path) as data:
+        if 'time' in data.files:
+            return data['time'], data['keypoints'].astype(np.int64)
+        selected = data['file'] == file_idx
+        return data['frame'][selected] / float(fps), data['keypoints'][selected].astype(np.int64)
+
+
+# QParam value after every frame for each decay, shape (frames, decays).
+# Steps the same recurrence as QParam.update for all decays at once
+def qparam_series(keypoints, decays, min_value=0, max_value=255):
+    decays = np.asarray(decays, dtype=np.float64)
+    values = np.empty((len(keypoints), len(decays)), dtype=np.int16)
+
+    value = np.zeros(len(decays))
+    for idx, growth in enumerate(np.asarray(keypoints, dtype=np.float64) * 8):
+        value = np.trunc(np.clip(value + (growth / np.maximum(value, 1) - decays), min_value, max_value))
+        values[idx] = value
+    return values
+
+
+# Collapse per frame snow flags (frames, combos) into per second flags
+# (seconds, combos) of the seconds an EventWindow would have closed. Returns
+# the first second and the flags. A second is closed once a later timestamp
+# (or `end`) is seen, like EventWindow.tick
+def snow_seconds(times, snow, end=None):
+    seconds = np.asarray(times).astype(np.int64)
+    first = int(seconds[0])
+    last = int(end) if end is not None else int(seconds[-1])
+
+    flags = np.zeros((max(last - first, 0), snow.shape[1]), dtype=bool)
+    closed = seconds < last
+    if closed.any():
+        uniq, starts = np.unique(seconds[closed], return_index=True)
+        flags[uniq - first] = np.logical_or.reduceat(snow[closed], starts, axis=0)
+    return first, flags
+
+
+# Run the EventWindow decision logic over per second flags for every combo.
+# columns picks the flags column of each combo, the other arguments are per
+# combo arrays. Returns (seconds, combo indices) of every notification
+def window_notifications(first, flags, columns, notify_thresholds, not_snowing_thresholds, refractory,
+                         window=constant.NOTIFY_EVENT_WINDOW_SECS, refrac_init=None):
+    notify_at = window * np.asarray(notify_thresholds, dtype=np.float64)
+    quiet_at = window * np.asarray(not_snowing_thresholds, dtype=np.float64)
+    refractory = np.asarray(refractory, dtype=np.int64)
+    timer = refractory.copy() if refrac_init is None else np.full(len(refractory), refrac_init, dtype=np.int64)
+
+    if len(flags) < window:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # Snow seconds in the window ending at every second once the window is full
+    cumulative = np.cumsum(flags, axis=0, dtype=np.int32)
+    counts = cumulative[window - 1:].copy()
+    counts[1:] -= cumulative[:-window]
+
+    fired_seconds, fired_combos = [], []
+    for offset, row in enumerate(counts):
+        snow = row[columns]
+        snowing = snow >= notify_at
+
+        fire = snowing & (timer >= refractory)
+        if fire.any():
+            combos = np.flatnonzero(fire)
+            fired_combos.append(combos)
+            fired_seconds.append(np.full(len(combos), first + window - 1 + offset, dtype=np.int64))
+
+        quiet = ~snowing & (window - snow >= quiet_at)
+        timer = np.where(snowing, 0, timer + (quiet & (timer <= refractory)))
+
+    if not fired_combos:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(fired_seconds), np.concatenate(fired_combos)
+
+
+class SweepResult(object):
+
+    def __init__(self, combos, seconds, combo):
+        self.combos = combos        # COMBO_DTYPE row per parameter combination
+        self.seconds = seconds      # Second of every notification ...
+        self.combo = combo          # ... and the combination it fired for
+
+    def notifications(self, combo_idx):
+        return self.seconds[self.combo == combo_idx]
+
+    def counts(self):
+        return np.bincount(self.combo, minlength=len(self.combos))
+
+    def save(self, path):
+        np.savez_compressed(path, notify_second=self.seconds, notify_combo=self.combo,
+                            **dict((name, self.combos[name]) for name in COMBO_DTYPE.names))
+
+
+#
+# Replay recorded keypoint counts through QParam and the EventWindow for the
+# whole grid of parameters. QParam runs once per distinct decay and the window
+# once per second, each step vectorised across all combinations.
+# thresholds of None uses decay + 1 like snow_detect.main.
+#
+def sweep(times, keypoints, decays=(constant.IMPULSE_DECAY,), thresholds=None,
+          notify_thresholds=(constant.NOTIFY_THRESHOLD,), not_snowing_thresholds=(constant.NOT_SNOWING_THRESHOLD,),
+          refractory=(constant.NOTIF_REFRACTORY_SECS,), window=constant.NOTIFY_EVENT_WINDOW_SECS,
+          refrac_init=None, end=None):
+    decays = np.unique(np.asarray(decays, dtype=np.float64))
+    q_values = qparam_series(keypoints, decays)
+
+    # (decay, threshold) pairs, each one a column of per frame snow flags
+    pairs = [(d_idx, decays[d_idx], threshold) for d_idx in range(len(decays))
+             for threshold in (thresholds if thresholds is not None else (decays[d_idx] + 1,))]
+    snow = np.stack([q_values[:, d_idx] > threshold for d_idx, _, threshold in pairs], axis=1)
+    first, flags = snow_seconds(times, snow, end=end)
+
+    grid = list(itertools.product(range(len(pairs)), notify_thresholds, not_snowing_thresholds, refractory))
+    combos = np.array([(pairs[col][1], pairs[col][2], notify, quiet, refrac) for col, notify, quiet, refrac in grid],
+                      dtype=COMBO_DTYPE)
+    columns = np.array([col for col, _, _, _ in grid], dtype=np.intp)
+
+    seconds, combo = window_notifications(first, flags, columns, combos['notify_threshold'],
+                                          combos['not_snowing_threshold'], combos['refractory'],
+                                          window=window, refrac_init=refrac_init)
+    return SweepResult(combos, seconds, combo)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Sweep QParam and event window settings over recorded keypoint counts')
+    parser.add_argument('counts', type=str, help='snow_detect.py --record-counts output or batch.py output')
+    parser.add_argument('--file-index', type=int, default=0, help='File to replay from a batch.py output')
+    parser.add_argument('--decay', type=float, nargs='+', default=[constant.IMPULSE_DECAY])
+    parser.add_argument('--threshold', type=float, nargs='+', default=None,
+                        help='QParam values above which a frame counts as snow (default: decay + 1)')
+    parser.add_argument('--notify-threshold', type=float, nargs='+', default=[constant.NOTIFY_THRESHOLD])
+    parser.add_argument('--not-snowing-threshold', type=float, nargs='+', default=[constant.NOT_SNOWING_THRESHOLD])
+    parser.add_argument('--refractory', type=int, nargs='+', default=[constant.NOTIF_REFRACTORY_SECS])
+    parser.add_argument('--window', type=int, default=constant.NOTIFY_EVENT_WINDOW_SECS)
+    parser.add_argument('--output', '-o', type=str, default=None, help='Write notifications per combination (.npz)')
+    args = parser.parse_args()
+
+    times, keypoints = load_counts(args.counts, file_idx=args.file_index)
+    started = time.time()
+    result = sweep(times, keypoints, decays=args.decay, thresholds=args.threshold,
+                   notify_thresholds=args.notify_threshold, not_snowing_thresholds=args.not_snowing_threshold,
+                   refractory=args.refractory, window=args.window)
+    print("Replayed %d frames x %d combinations in %.2fs" % (len(keypoints), len(result.combos), time.time() - started))
+
+    print("%8s %10s %8s %8s %10s %6s  %s" % ('decay', 'threshold', 'notify', 'quiet', 'refractory', 'count',
+                                             'first notifications (s)'))
+    for idx, (combo, count) in enumerate(zip(result.combos, result.counts())):
+        seconds = result.notifications(idx)[:5] - int(times[0])
+        print("%8g %10g %8g %8g %10d %6d  %s" % (combo['decay'], combo['threshold'], combo['notify_threshold'],
+                                                  combo['not_snowing_threshold'], combo['refractory'], count,
+                                                  " ".join(str(second) for second in seconds)))
+
+    if args.output:
+        result.save(args.output)
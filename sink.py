@@ -0,0 +1,71 @@
+import cv2 as cv
+import numpy as np
+import constant
+from stream import OutputStream
+
+
+# Draw detected keypoints and the current confidence on a copy of the frame
+def draw_detections(frame, keypoints, snow_confidence):
+    displayed = cv.drawKeypoints(frame, keypoints, np.array([]), (0, 0, 255),
+                                 cv.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
+
+    cv.putText(displayed, "Detects: " + str(snow_confidence), (40, 30), cv.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2,
+               cv.LINE_AA)
+    return displayed
+
+
+#
+# Frame sinks. Each sink gets every frame coming out of the detection loop
+# through show() and returns False when the loop should stop.
+#
+
+# HighGUI windows showing the annotated frame (and the foreground mask when debugging)
+class DisplaySink(object):
+
+    def __init__(self, wait_ms=30, debug=constant.DEBUG):
+        self.wait_ms = wait_ms
+        self.debug = debug
+
+        #Set up view and mask output windows
+        cv.namedWindow('view', cv.WINDOW_NORMAL)
+        cv.resizeWindow('view', constant.FrameSize.WIDTH.value, constant.FrameSize.HEIGHT.value)
+
+        if self.debug:
+            cv.namedWindow('mask', cv.WINDOW_NORMAL)
+            cv.resizeWindow('mask', constant.FrameSize.WIDTH.value, constant.FrameSize.HEIGHT.value)
+
+    def show(self, frame, detector, snow_confidence):
+        cv.imshow('view', draw_detections(frame, detector._debug_keypoints, snow_confidence))
+        if self.debug and detector._debug_mask is not None:
+            cv.imshow('mask', detector._debug_mask)
+
+        # Stop on ESC
+        return cv.waitKey(self.wait_ms) & 0xff != 27
+
+    def close(self):
+        cv.destroyAllWindows()
+
+
+# Restream the annotated frame through an OutputStream. The encoder is
+# opened on the first frame so it matches whatever size the loop produces
+class RestreamSink(object):
+
+    # target, fmt: See OutputStream
+    def __init__(self, target=None, fmt=None, fps=constant.SOURCE_FPS):
+        self.target = target
+        self.fmt = fmt
+        self.fps = fps
+        self._output = None
+
+    def show(self, frame, detector, snow_confidence):
+        # draw_detections returns a new frame, safe to hand to the writer thread
+        displayed = draw_detections(frame, detector._debug_keypoints, snow_confidence)
+        if self._output is None:
+            self._output = OutputStream(width=displayed.shape[1], height=displayed.shape[0], fps=self.fps,
+                                        target=self.target, fmt=self.fmt)
+        self._output.send_video_frame(displayed)
+        return True
+
+    def close(self):
+        if self._output is not None:
+            self._output.close()
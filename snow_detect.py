@@ -1,84 +1,189 @@
-import cv2 as cv
-import numpy as np
-import constant as c
 import time
 import constant
 import exceptions
+import logging
+import metrics
 
 
-from detect import SnowDetector
-from stream import ArmoryCamStream, FileStream, OutputStream
-from filter import blur, resize
+from detect import SnowDetector, roi_bounding_rect, load_roi_polygons, decay_schedule, BLOB_BACKENDS
+from stream import ArmoryCamStream, SeekableFileStream
+from filter import Preprocessor
 from snowtify import Snowtification
+from pipeline import Pipeline, StatsReporter, DROP_OLDEST, POLICIES
+from sink import DisplaySink, RestreamSink
+from replay import CountRecorder
+from journal import EventJournal
 
 
-def main(filename=None, offset_frames=0, refrac_init=None):
+logger = logging.getLogger(__name__)
 
-    last_frame = None
-    snow_confidence = 0
+# --channel names to SnowDetector channel values
+CHANNELS = {'gray': 'gray', 'blue': 0, 'green': 1, 'red': 2}
+
+
+def main(filename=None, start=None, refrac_init=None, decoder_scale=False, decoder_crop=False,
+         analysis_fps=None, pipeline=False, queue_policy=DROP_OLDEST, headless=False,
+         roi=constant.ROI_POLYGONS, channel=constant.DETECT_CHANNEL, roi_crop=constant.DETECT_CROP,
+         blob_backend=constant.BLOB_BACKEND, checkpoint=None, record_counts=None, restream=None,
+         motion_gate=constant.MOTION_GATE, decay=constant.DECAY_SCHEDULE, journal=None):
 
-    #Set up view and mask output windows
-    cv.namedWindow('view', cv.WINDOW_NORMAL)
-    cv.resizeWindow('view', c.FrameSize.WIDTH.value, c.FrameSize.HEIGHT.value)
-    font = cv.FONT_HERSHEY_SIMPLEX
+    # A file is read far faster than it is analysed. Dropping queued frames
+    # would skip most of it, and the recording clock would follow the reader
+    # thread instead of the analysed frame
+    if pipeline and filename is not None:
+        raise ValueError("The pipeline only runs on the live stream, not on a file")
 
-    if constant.DEBUG == True:
-        cv.namedWindow('mask', cv.WINDOW_NORMAL)
-        cv.resizeWindow('mask', c.FrameSize.WIDTH.value, c.FrameSize.HEIGHT.value)
+    snow_confidence = 0
 
-    # Initialize detector
-    detector = SnowDetector()
+    # Anything that wants to see the frames. Headless runs have no windows and
+    # no waitKey throttle, so frames are processed as fast as they arrive
+    sinks = []
+    if not headless:
+        sinks.append(DisplaySink())
 
-    # Initialize Snowtification
-    snowtify = Snowtification(refrac_init)
+    # Let ffmpeg scale (and crop) the live stream to FrameSize inside the decoder
+    decoder_scale = decoder_scale and filename is None
+    crop = roi_bounding_rect(roi) if decoder_scale and decoder_crop else None
 
     # Read frames from file if provided, otherwise read from live stream
     if filename is not None:
-        stream = FileStream(filename, offset=offset_frames)
+        stream = SeekableFileStream(filename, start_time=start, analysis_fps=analysis_fps)
+    else:
+        stream = ArmoryCamStream(scaled=decoder_scale, crop=crop, analysis_fps=analysis_fps)
+
+    # Unix time the frame being analysed was recorded at
+    recorded_time = stream.recorded_time if filename is not None else time.time
+
+    # Initialize detector. A decay schedule follows the time of day of the frames
+    detector = SnowDetector(roi=roi, origin=crop[:2] if crop else (0, 0), channel=channel, crop=roi_crop,
+                            blob_backend=blob_backend, checkpoint=checkpoint, motion_gate=motion_gate,
+                            decay=decay_schedule(decay, clock=recorded_time))
+
+    # Restream the annotated frames, to twitch when STREAMING is on, or to a
+    # file ('null' to only run the encoder)
+    if restream == 'null':
+        sinks.append(RestreamSink(target='-', fmt='null', fps=analysis_fps or constant.SOURCE_FPS))
+    elif restream is not None:
+        sinks.append(RestreamSink(target=restream, fps=analysis_fps or constant.SOURCE_FPS))
+    elif constant.STREAMING and filename is None:
+        sinks.append(RestreamSink(fps=analysis_fps or constant.SOURCE_FPS))
+
+    # Initialize Snowtification. Recordings run on their own media clock so
+    # the event window sees the same seconds however fast frames are decoded
+    clock = stream.timestamp if filename is not None else time.monotonic
+    # Journal of analysed frames, window seconds and notifications. The event
+    # window on the live feed carries on from the state it holds, recordings
+    # are journaled at the time they were recorded
+    if not journal:
+        journal = None
+    elif filename is not None:
+        journal = EventJournal(journal, clock=recorded_time, recording=True)
     else:
-        stream = ArmoryCamStream()
-        if constant.STREAMING:
-            twitch = OutputStream()
+        journal = EventJournal(journal)
+    snowtify = Snowtification(refrac_init, clock=clock, journal=journal)
+
+    # Raw keypoint counts for sweeping the QParam and window settings in replay.py
+    recorder = CountRecorder(record_counts) if record_counts else None
 
     try:
         with stream:
-            stream = resize(stream, scale=.25)
-            stream = blur(stream, kernel_size=3)
+            # When the stream drops frames itself every frame it hands out gets analysed
+            hop = 1 if analysis_fps else constant.FRAME_HOP
+
+            # Without sinks only the analysed frames are ever preprocessed
+            preprocess_hop = hop
+            if sinks:
+                preprocess_hop = 1
+            else:
+                hop = 1
+
+            # The decoder already scaled the live stream, only blur it then
+            scale = 1 if decoder_scale else constant.PREPROCESS_SCALE
+
+            # Decoding started at the keyframe before `start`, those frames
+            # only warm up the detector
+            if filename is not None:
+                warm_up(stream, detector, Preprocessor(scale=scale), hop=1 if analysis_fps else constant.FRAME_HOP)
+
+            if pipeline:
+                # Read and preprocess on a thread feeding a bounded queue. The
+                # decoded frame is used up before the next read, only fresh
+                # preprocessed frames are queued
+                preprocessor = Preprocessor(scale=scale, pool_size=None)
+                stream = Pipeline(preprocessor.frames(stream, hop=preprocess_hop), policy=queue_policy)
+                stream.start()
+                reporter = StatsReporter(stream)
+            else:
+                stream = Preprocessor(scale=scale).frames(stream, hop=preprocess_hop)
 
             # Use custom built iterator in ArmoryCamStream object to keep grabbing
             # frames from the video
             frame_hop = 0
             for frame in stream:
 
-                if frame_hop > 3:
+                if pipeline:
+                    reporter.tick()
+
+                frame_hop += 1
+                if frame_hop >= hop:
                     frame_hop = 0
+                    detect_start = time.perf_counter()
                     snow_confidence = detector.detect(frame)
+                    metrics.STAGE_LATENCY.observe(time.perf_counter() - detect_start, 'detect')
+                    metrics.FRAMES_ANALYSED.inc()
+                    metrics.QPARAM.set(snow_confidence)
+                    snowtify.log_frame(frame, snow_confidence)
+                    if recorder is not None:
+                        recorder.record(clock(), len(detector._debug_keypoints))
+                    snowtify.tick()
 
                     # If we exceed impulse decay we've detected snow. Log it.
-                    if snow_confidence > constant.IMPULSE_DECAY + 1:
+                    snow = snow_confidence > detector.threshold
+                    if journal is not None:
+                        journal.frame(snow_confidence, len(detector._debug_keypoints), snow)
+                    if snow:
                         snowtify.log_snow_event()
 
-                displayed = cv.drawKeypoints(frame, detector._debug_keypoints, np.array([]), (0, 0, 255),
-                                             cv.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
-
-                cv.putText(displayed, "Detects: " + str(snow_confidence), (40, 30), font, 1, (0, 0, 255), 2,
-                           cv.LINE_AA)
-
-                cv.imshow('view', displayed)
-                # if constant.STREAMING is True:
-                if constant.STREAMING:
-                    twitch.send_video_frame(displayed)
-                if constant.DEBUG:
-                    cv.imshow('mask', detector._debug_mask)
-                if cv.waitKey(30) & 0xff == 27:
+                keep_going = True
+                for sink in sinks:
+                    keep_going = sink.show(frame, detector, snow_confidence) and keep_going
+                if not keep_going:
                     break
 
-                frame_hop += 1
+    except exceptions.StreamError as e:
+        logger.error(e.message)
+    finally:
+        if pipeline and isinstance(stream, Pipeline):
+            stream.stop()
+        for sink in sinks:
+            sink.close()
+        snowtify.stop_threads()
+        if checkpoint:
+            detector.save_checkpoint()
+        if recorder is not None:
+            recorder.save()
+        if journal is not None:
+            journal.close()
 
 
+# Run the frames a SeekableFileStream decodes ahead of its start frame
+# through the detector only. Nothing is counted, journaled, recorded or shown
+def warm_up(stream, detector, preprocessor, hop=1):
+    skipped = 0
+    while stream.warming_up:
+        frame = next(stream)
+        skipped += 1
+        if skipped >= hop:
+            skipped = 0
+            detector.detect(preprocessor(frame))
 
-    except exceptions.StreamError as e:
-        print(e.message)
+
+# Seconds from a number of seconds or [HH:]MM:SS
+def parse_time(value):
+    seconds = 0.0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
 
 
 if __name__ == '__main__':
@@ -87,13 +192,67 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--file', '-f', type=str)
-    parser.add_argument('--offset-frames', type=int, default=0)
+    parser.add_argument('--start', type=parse_time, default=None,
+                        help='Start this far into --file, in seconds or [HH:]MM:SS')
     parser.add_argument('--refractory', type=int, default=constant.NOTIF_REFRACTORY_SECS)
+    parser.add_argument('--analysis-fps', type=float, default=None,
+                        help='Drop frames inside the decoder down to this rate (e.g. %g)' % constant.ANALYSIS_FPS)
+    parser.add_argument('--roi', type=str, default=None,
+                        help='JSON file of ROI polygons ([[[x, y], ...], ...]) in FrameSize coordinates')
+    parser.add_argument('--channel', choices=sorted(CHANNELS), default=None,
+                        help='Feed a single channel to the background model instead of BGR')
+    parser.add_argument('--roi-crop', action='store_true',
+                        help='Only feed the ROI bounding box to the background model')
+    parser.add_argument('--blob-backend', choices=BLOB_BACKENDS, default=constant.BLOB_BACKEND,
+                        help='Blob counter run on the foreground mask')
+    parser.add_argument('--decay-schedule', type=str, default=constant.DECAY_SCHEDULE,
+                        help="'adaptive' to follow the keypoint noise floor, or a JSON file of {hour: decay}")
+    parser.add_argument('--motion-gate', action='store_true',
+                        help='Skip the background model on analysed frames where nothing in the ROI moved')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Save the background model to this .npz file and warm start from it')
+    parser.add_argument('--journal', type=str, default=None,
+                        help='Append detections and notifications to this event journal and restore from it. '
+                             'Live and --file runs need separate journals')
+    parser.add_argument('--record-counts', type=str, default=None,
+                        help='Save per frame keypoint counts to this .npz file for replay.py')
+    parser.add_argument('--restream', type=str, default=None,
+                        help="Encode the annotated frames to this file, or 'null' to only run the encoder")
+    parser.add_argument('--metrics-port', type=int, default=constant.METRICS_PORT,
+                        help='Serve Prometheus metrics on this local port (0 to disable)')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--headless', action='store_true',
+                        help='Run without any windows or display throttling (e.g. as a service)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Decode and filter the live stream on a separate thread feeding a bounded queue')
+    parser.add_argument('--queue-policy', choices=POLICIES, default=DROP_OLDEST,
+                        help='What to drop when a pipeline queue is full')
+    parser.add_argument('--decoder-scale', action='store_true',
+                        help='Have ffmpeg scale the live stream to FrameSize while decoding')
+    parser.add_argument('--decoder-crop', action='store_true',
+                        help='Also crop the live stream to the ROI bounding box (implies --decoder-scale)')
     args = parser.parse_args()
+    if args.pipeline and args.file:
+        parser.error('--pipeline only runs on the live stream, not with --file')
+
+    logging.basicConfig(level=args.log_level,
+                        format='%(asctime)s level=%(levelname)s logger=%(name)s %(message)s')
+    if args.metrics_port:
+        metrics.start_http_server(port=args.metrics_port)
 
     if args.file is None:
         filename = None
     else:
         filename = os.path.abspath(args.file)
 
-    main(filename=filename, offset_frames=args.offset_frames, refrac_init=args.refractory)
+    roi = constant.ROI_POLYGONS if args.roi is None else load_roi_polygons(args.roi)
+
+    main(filename=filename, start=args.start, refrac_init=args.refractory,
+         decoder_scale=args.decoder_scale or args.decoder_crop, decoder_crop=args.decoder_crop,
+         analysis_fps=args.analysis_fps, pipeline=args.pipeline, queue_policy=args.queue_policy,
+         headless=args.headless, roi=roi,
+         channel=CHANNELS[args.channel] if args.channel else constant.DETECT_CHANNEL,
+         roi_crop=args.roi_crop or constant.DETECT_CROP, blob_backend=args.blob_backend,
+         checkpoint=args.checkpoint, record_counts=args.record_counts,
+         restream=args.restream, motion_gate=args.motion_gate or constant.MOTION_GATE,
+         decay=args.decay_schedule, journal=args.journal)
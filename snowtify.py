@@ -1,222 +1,444 @@
 from threading import Thread, Event
+import array
+import concurrent.futures
+import threading
 import time
 import math
 import constant
 import queue
 import requests
+import requests.adapters
 import api
 from twython import Twython
 import datetime
-import os
+import io
+import logging
+import cv2 as cv
+import numpy as np
+
+import metrics
+from journal import SECOND, SNOWING, RECORDING
+
+logger = logging.getLogger(__name__)
 
 # Set shared queue for thread of size 1 to hold notification trigger
 notif_q = queue.Queue(1)
 
 
 #
-# Producer Thread for notifications
+# Producer for notifications
 #
-class EventWindow(Thread):
-
-    # Class Constants
-    WAIT_TIME = 1.0  # Number of seconds to wait for next task
-
-    # Class Variables
-    _notify_window = constant.NOTIFY_EVENT_WINDOW_SECS
-    _notify_threshold = constant.NOTIFY_EVENT_WINDOW_SECS * constant.NOTIFY_THRESHOLD
-    _no_snow_threshold = constant.NOTIFY_EVENT_WINDOW_SECS * constant.NOT_SNOWING_THRESHOLD
-    _snow_event_handler = False
-    _snow_events = 0          # How many snow detections has there been
-    _no_snow_events = 0       # How many no snow detections has there been
-    _is_it_snowing = False    # Boolean for is it snowing or not
-    _refractory_timer = 0     # How long has it been since it's stopped snowing, after notification
-
-    def __init__(self, event, refrac_init=0):
-        Thread.__init__(self)
-        self.stopped = event
-        self._refractory_timer = refrac_init
-
-    def run(self):
-
-        # Run task every second
-        while not self.stopped.wait(self.WAIT_TIME):
-
-            # Start pseudo circular buffer logic once we collect enough data points
-            # keep snow events + no snow events at _notify_window's value
-            # Since we are looping every second, we can assume snow & no snow
-            # are updated every second. We want snow + no snow = _notify_window
-            # for a filled "pseudo circular buffer"
-
-            # If (Filled circular buffer [Good!])
-            if self._snow_events + self._no_snow_events >= self._notify_window:
+# Sliding window over the last _notify_window seconds, kept in a fixed size
+# ring buffer of per second snow event counts. Detections are bucketed by
+# second on insert and every second that completes is evaluated right away,
+# so there is no polling thread. Time comes from `clock` (monotonic by
+# default) or from explicit timestamps, which is what lets a recorded event
+# stream be replayed faster than real time.
+#
+class EventWindow(object):
+
+    def __init__(self, refrac_init=0, window=constant.NOTIFY_EVENT_WINDOW_SECS,
+                 notify_threshold=constant.NOTIFY_THRESHOLD, no_snow_threshold=constant.NOT_SNOWING_THRESHOLD,
+                 refractory_secs=constant.NOTIF_REFRACTORY_SECS, clock=time.monotonic, notify=None, journal=None):
+        self._notify_window = window
+        self._notify_threshold = window * notify_threshold
+        self._no_snow_threshold = window * no_snow_threshold
+        self._refractory_secs = refractory_secs
+        self._clock = clock
+        self._notify = notify if notify is not None else self.send_notification
+        self._lock = threading.Lock()
+
+        self._counts = array.array('I', [0] * window)   # Snow events per completed second
+        self.reset_vals(refractory=refrac_init or 0)
+
+        # Closed seconds and notifications go to the journal, and a window on
+        # the live feed picks up where the last live run left off. The time
+        # spent down is measured on the journal's wall clock
+        self._journal = None
+        if journal is not None and not journal.recording:
+            records = journal.tail(SECOND, window)
+            records = records[(records['flags'] & RECORDING) == 0]
+            if len(records):
+                self.restore(records, elapsed=max(int(journal.now() - records[-1]['time']), 0))
+        self._journal = journal
+
+    def log_snow_event(self, timestamp=None):
+        with self._lock:
+            self._advance(self._now(timestamp))
+            self._current_count += 1
+
+    # Bring the window up to date without logging anything
+    def tick(self, timestamp=None):
+        with self._lock:
+            self._advance(self._now(timestamp))
+
+    # Feed a recorded stream of snow event timestamps through the window as
+    # fast as possible. Returns the seconds at which notifications would fire
+    def replay(self, timestamps, end=None):
+        fired = []
+        notify = self._notify
+        self._notify = fired.append
+        try:
+            for timestamp in timestamps:
+                self.log_snow_event(timestamp)
+            if end is not None:
+                self.tick(end)
+        finally:
+            self._notify = notify
+        return fired
+
+    def _now(self, timestamp):
+        return self._clock() if timestamp is None else timestamp
+
+    def _advance(self, now):
+        second = int(now)
+        if self._second is None:
+            self._second = second
+            return
+
+        elapsed = second - self._second
+        if elapsed <= 0:
+            return
+
+        # Close out the current second, then the empty seconds in between
+        self._close_second(self._second, self._current_count)
+        self._close_empty(self._second + 1, elapsed - 1)
+
+        self._second = second
+        self._current_count = 0
+
+    # Close `empty` seconds without snow starting at `second`. After a full
+    # window of empty seconds every further second looks the same, so only the
+    # refractory timer needs catching up
+    def _close_empty(self, second, empty):
+        for offset in range(min(empty, self._notify_window)):
+            self._close_second(second + offset, 0)
+        if empty > self._notify_window:
+            caught_up = min(self._refractory_timer + empty - self._notify_window, self._refractory_secs + 1)
+            self._refractory_timer = max(self._refractory_timer, caught_up)
+
+    def _close_second(self, second, count):
+        head = self._head
+        if self._filled < self._notify_window:
+            self._filled += 1
+        elif self._counts[head]:
+            self._snow_seconds -= 1
+
+        self._counts[head] = count
+        if count:
+            self._snow_seconds += 1
+        self._head = (head + 1) % self._notify_window
+
+        # Start deciding once the window holds enough data points
+        if self._filled >= self._notify_window:
+            self._evaluate(second)
+
+        if self._journal is not None:
+            self._journal.second(count, self._snow_seconds, self._refractory_timer, self._is_it_snowing)
+
+    def _evaluate(self, second):
+        no_snow_seconds = self._filled - self._snow_seconds
+
+        metrics.EVENT_WINDOW_SNOW.set(self._snow_seconds)
+        metrics.EVENT_WINDOW_FILL.set(float(self._snow_seconds) / self._notify_window)
+
+        # Determine if it is snowing
+        if self._snow_seconds >= self._notify_threshold:
+
+            # Its snowing!
+            self._is_it_snowing = True
+
+            # IF an acceptable amount no snow time has passed
+            if self._refractory_timer >= self._refractory_secs:
+
+                # Send Notification. Returns the confidence of the attached
+                # snapshot, if any
+                confidence = self._notify(second)
+                if self._journal is not None:
+                    self._journal.notification(second, confidence)
+
+            # Reset refractory timer to 0. It's snowing again!
+            self._refractory_timer = 0
+
+        # Determine if it is not snowing for refractory timer
+        elif no_snow_seconds >= self._no_snow_threshold:
+            self._is_it_snowing = False
+
+            # IF we haven't hit the threshold yet
+            if self._refractory_timer <= self._refractory_secs:
+                self._refractory_timer += 1
+        metrics.REFRACTORY.set(self._refractory_timer)
+        logger.debug("window second=%d snow=%d no_snow=%d snowing=%s refractory=%d", second, self._snow_seconds,
+                     no_snow_seconds, self._is_it_snowing, self._refractory_timer)
+
+    # Rebuild the ring and refractory timer from journaled SECOND records
+    # (oldest first, at most a window of them), then account for the
+    # `elapsed` seconds that passed since the last one without any snow
+    def restore(self, records, elapsed=0):
+        with self._lock:
+            records = records[-self._notify_window:]
+            last = records[-1]
+            self.reset_vals(snowing=bool(last['flags'] & SNOWING), refractory=int(last['refractory']))
+            for count in records['count']:
+                self._counts[self._head] = int(count)
+                if count:
+                    self._snow_seconds += 1
+                self._head = (self._head + 1) % self._notify_window
+            self._filled = len(records)
+
+            # The seconds spent down are not journaled again
+            journal, self._journal = self._journal, None
+            try:
+                self._close_empty(int(self._now(None)) - elapsed, elapsed)
+            finally:
+                self._journal = journal
+        logger.info("Restored event window from journal snow=%d refractory=%d down=%ds",
+                    self._snow_seconds, self._refractory_timer, elapsed)
 
-                print("buffer full!")
+    @staticmethod
+    def send_notification(second=None, notif_event=True):
+        logger.warning("SEND THE SNOWTIFICATION! second=%s", second)
 
-                # IF ( there is a snow event to log )
-                if self._snow_event_handler:
+        # Add notification to notification queue
+        # Never block the detector, one pending notification is enough
+        try:
+            notif_q.put_nowait(notif_event)
+        except queue.Full:
+            logger.info("Notification already pending")
+
+    def reset_vals(self, snowing=False, refractory=constant.NOTIF_REFRACTORY_SECS):
+        for idx in range(self._notify_window):
+            self._counts[idx] = 0
+        self._head = 0              # Ring slot the next completed second goes into
+        self._filled = 0            # Completed seconds in the ring
+        self._second = None         # Second currently being collected
+        self._current_count = 0     # Snow events logged in the current second
+        self._snow_seconds = 0      # Seconds in the ring with at least one snow event
+        self._is_it_snowing = snowing
+        self._refractory_timer = refractory
 
-                    print("incrementing snow event!")
+# What gets handed to the notification channels
+class Notification(object):
 
-                    # Reset event handler and increment snow event if we havent
-                    # reached maximum
-                    self._snow_event_handler = False
-                    if self._snow_events >= self._notify_window:
-                        self._snow_events = self._notify_window
-                    else:
-                        self._snow_events += 1
+    def __init__(self, image=None, confidence=None, time=None, camera=None):
+        self.image = image                  # JPEG encoded snapshot (bytes) or None
+        self.confidence = confidence        # QParam value of the snapshot
+        self.time = time if time is not None else datetime.datetime.now()
+        self.camera = camera                # Name of the camera, None for the single camera setup
 
-                    # Decrement no snow event, but make sure
-                    # no snow events stays positive
-                    if self._no_snow_events > 0:
-                        self._no_snow_events -= 1
 
-                # ELSE ( No snow event to log! )
-                else:
+#
+# Keeps the analysed frame with the highest QParam value seen over the last
+# `window` seconds in a preallocated buffer. Frames are only copied when they
+# beat the current peak (a tie keeps the earlier frame), and only JPEG
+# encoded when a notification fires. The snapshot is the analysed frame,
+# blurred at analysis scale, or only the ROI box when the decoder crops.
+#
+class SnapshotBuffer(object):
+
+    def __init__(self, window=constant.NOTIFY_EVENT_WINDOW_SECS, clock=time.monotonic,
+                 jpeg_quality=constant.SNAPSHOT_JPEG_QUALITY):
+        self._window = window
+        self._clock = clock
+        self._jpeg_quality = jpeg_quality
+        self._frame = None
+        self._confidence = None
+        self._time = None
+
+    # Returns True if the frame became the new peak
+    def log_frame(self, frame, confidence):
+        now = self._clock()
+        stale = self._time is None or now - self._time > self._window
+        if not stale and confidence <= self._confidence:
+            return False
+
+        if self._frame is None or self._frame.shape != frame.shape:
+            self._frame = frame.copy()
+        else:
+            np.copyto(self._frame, frame)
+        self._confidence = confidence
+        self._time = now
+        return True
+
+    # JPEG bytes of the peak frame, or None if there is nothing to send
+    def encode(self):
+        if self._frame is None:
+            return None
+        success, jpeg = cv.imencode('.jpg', self._frame, [cv.IMWRITE_JPEG_QUALITY, self._jpeg_quality])
+        return jpeg.tobytes() if success else None
+
+    def notification(self):
+        return Notification(image=self.encode(), confidence=self._confidence)
 
-                    # Increment no snow event only if below _notify_window value
-                    if self._no_snow_events >= self._notify_window:
-                        self._no_snow_events = self._notify_window
-                    else:
-                        self._no_snow_events += 1
 
-                    # Decrement snow event, but make sure
-                    # snow events stays positive
-                    if self._snow_events > 0:
-                        self._snow_events -= 1
+#
+# Notification channels
+# Each channel sends one notification with send(notif_event) and raises on
+# failure. Clients and HTTP sessions are created once and reused.
+#
 
-                ################################################################
-                #
-                # All values now up to date for this second
-                #
-                ################################################################
+# Pooled HTTP session shared by the HTTP based channels
+def make_session(pool_size=constant.NOTIF_HTTP_POOL_SIZE):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-                print("snow events: " + str(self._snow_events))
-                print("no snow events: " + str(self._no_snow_events))
 
-                # Determine if it is snowing
-                if self._snow_events >= self._notify_threshold:
+class YoChannel(object):
 
-                    # Its snowing!
-                    self._is_it_snowing = True
+    def __init__(self, username, session, url=constant.YO_URL, api_token=None, link='www.armorycam.com',
+                 timeout=constant.NOTIF_HTTP_TIMEOUT_SECS):
+        self.name = 'yo:%s' % username
+        self._username = username
+        self._session = session
+        self._url = url
+        self._api_token = api_token if api_token is not None else api.YO_API
+        self._link = link
+        self._timeout = timeout
 
-                    # IF an acceptable amount no snow time has passed
-                    if self._refractory_timer >= constant.NOTIF_REFRACTORY_SECS:
+    def send(self, notif_event):
+        response = self._session.post(self._url, data={'api_token': self._api_token, 'username': self._username,
+                                                       'link': self._link}, timeout=self._timeout)
+        response.raise_for_status()
 
-                        # Send Notification
-                        self.send_notification()
 
-                    # Reset refractory timer to 0. It's snowing again!
-                    self._refractory_timer = 0
+####################################
+#
+#  TWITTER INTEGRATION
+#
+#####################################
+class TwitterChannel(object):
 
-                # Determine if it is not snowing for refractory timer
-                elif self._no_snow_events >= self._no_snow_threshold:
-                    self._is_it_snowing = False
+    name = 'twitter'
 
-                    # IF we haven't hit the threshold yet
-                    if self._refractory_timer <= constant.NOTIF_REFRACTORY_SECS:
-                        self._refractory_timer += 1
-                print("refractory: " + str(self._refractory_timer))
+    # client: Optional prebuilt Twython compatible client
+    def __init__(self, client=None):
+        self._client = client
 
-            # else (Circular buffer not filled [Sad!])
-            else:
+    def _twitter(self):
+        if self._client is None:
+            self._client = Twython(app_key=api.TW_CUSTOMER_API,
+                                   app_secret=api.TW_PRIV_API,
+                                   oauth_token=api.TW_OAUTH_TOKEN,
+                                   oauth_token_secret=api.TW_OAUTH_TOKEN_SECRET,
+                                   client_args={'timeout': constant.NOTIF_HTTP_TIMEOUT_SECS})
+        return self._client
 
-                if self._snow_event_handler:
-                    # Reset event handler and increment snow event
-                    self._snow_event_handler = False
-                    self._snow_events += 1
-                    print("incrementing snow event!")
-                else:
-                    self._no_snow_events += 1
+    def send(self, notif_event):
+        twitter = self._twitter()
 
-    def increment_snow_event(self):
-        self._snow_event_handler = True
-        print("logged snow event!")
+        if not isinstance(notif_event, Notification):
+            notif_event = Notification()
+        now = notif_event.time.strftime("%c")
+        status = 'It\'s snowing on ArmoryCam.com ❄ Tune in now! [' + now + ']'
+        if notif_event.camera is not None:
+            status += ' (' + notif_event.camera + ')'
 
-    @staticmethod
-    def send_notification():
-        print("############################")
-        print("# SEND THE SNOWTIFICATION! #")
-        print("############################")
+        # Upload the snapshot straight from memory
+        if notif_event.image is None:
+            twitter.update_status(status=status)
+            return
+        image_ids = twitter.upload_media(media=io.BytesIO(notif_event.image))
+        twitter.update_status(status=status, media_ids=[image_ids['media_id']])
 
-        # Add notification to notification queue
-        # Just passing value True at this time. Could pass object holding analytics
-        notif_q.put(True)
 
-    def reset_vals(self, event_handler=False,
-                   snow_events=0, no_snows=0,
-                   snowing=False, refractory=constant.NOTIF_REFRACTORY_SECS):
+def default_channels():
+    session = make_session()
+    return [YoChannel(api.JOHN_UN, session), YoChannel(api.BILL_UN, session), TwitterChannel()]
 
-        self._snow_event_handler = event_handler
-        self._snow_events = snow_events
-        self._no_snow_events = no_snows
-        self._is_it_snowing = snowing
-        self._refractory_timer = refractory
 
 #
 # Notification Consumer Thread
 #
+# Blocks on the notification queue and sends every notification to all
+# channels concurrently on a small thread pool. Each channel is retried with
+# exponential backoff until it succeeds or the deadline passes. Setting the
+# stop event (see stop()) wakes the thread and aborts pending retries.
+#
 class NotificationThread(Thread):
 
-    def __init__(self, event):
+    _STOP = object()    # Queue sentinel used to wake the thread on stop
+
+    def __init__(self, event, channels=None, notif_queue=None,
+                 retry_base=constant.NOTIF_RETRY_BASE_SECS, retry_max=constant.NOTIF_RETRY_MAX_SECS,
+                 deadline=constant.NOTIF_RETRY_DEADLINE_SECS):
         Thread.__init__(self)
+        self.daemon = True
         self.stopped = event
+        self._channels = channels
+        self._queue = notif_queue if notif_queue is not None else notif_q
+        self._retry_base = retry_base
+        self._retry_max = retry_max
+        self._deadline = deadline
 
     def run(self):
+        if self._channels is None:
+            self._channels = default_channels()
 
-        # Monitor for event
-        while True:
-            if not notif_q.empty():
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self._channels), 1))
+        try:
+            while not self.stopped.is_set():
 
                 # Get the item from the queue (which clears queue)
-                notif_event = notif_q.get()
+                notif_event = self._queue.get()
+                if self.stopped.is_set():
+                    break
+                if notif_event is self._STOP:
+                    # Left over from an earlier stop()
+                    continue
 
                 # Send notification
-                self.send_notification(notif_event)
-            time.sleep(1)
-
-    def send_notification(self, notif_event):
-
-        success = False
-
-        while success is not True:
-
-            if constant.DEBUG is not True:
-                # Send to yo!
-                try:
-                    requests.post("http://api.justyo.co/yo/", data={'api_token': api.YO_API, 'username': api.JOHN_UN,
-                                                                    'link': 'www.armorycam.com'})
-                    requests.post("http://api.justyo.co/yo/", data={'api_token': api.YO_API, 'username': api.BILL_UN,
-                                                                    'link': 'www.armorycam.com'})
-
-
-                    ####################################
-                    #
-                    #  TWITTER INTEGRATION
-                    #
-                    #####################################
-
-                    twitter = Twython(app_key=api.TW_CUSTOMER_API,
-                                      app_secret=api.TW_PRIV_API,
-                                      oauth_token=api.TW_OAUTH_TOKEN,
-                                      oauth_token_secret=api.TW_OAUTH_TOKEN_SECRET)
-
-                    now = datetime.datetime.now()
-                    now = now.strftime("%c")
-
-                    os.system("rm -rf /home/mayor/Pictures/current.jpg")
-                    os.system("curl https://tower.armorycam.com/ftpuploaduser/FI9821W_C4D655392937/snap/current.jpg > /home/mayor/Pictures/current.jpg")
+                self.send_notification(notif_event, executor)
+        finally:
+            executor.shutdown(wait=True)
+
+    def stop(self):
+        self.stopped.set()
+        try:
+            self._queue.put_nowait(self._STOP)
+        except queue.Full:
+            # A pending notification will wake the thread instead
+            pass
+
+    # Send to every channel at once. Returns {channel name: success}
+    def send_notification(self, notif_event, executor):
+        if constant.DEBUG is True:
+            logger.info("Notifications Disabled. Debugging Mode")
+            return {}
+
+        deadline = time.monotonic() + self._deadline
+        futures = dict((channel.name, executor.submit(self._send_with_retry, channel, notif_event, deadline))
+                       for channel in self._channels)
+        return dict((name, future.result()) for name, future in futures.items())
+
+    def _send_with_retry(self, channel, notif_event, deadline):
+        start = time.monotonic()
+        sent = self._retry(channel, notif_event, deadline)
+        metrics.NOTIFICATION_LATENCY.observe(time.monotonic() - start, channel.name)
+        metrics.NOTIFICATIONS.inc(1, channel.name, 'sent' if sent else 'failed')
+        return sent
+
+    def _retry(self, channel, notif_event, deadline):
+        attempt = 0
+        while True:
+            try:
+                channel.send(notif_event)
+                logger.info("Sent notification to %s", channel.name)
+                return True
+            except Exception as e:
+                logger.warning("Could not send update to %s: %r", channel.name, e)
 
-                    photo = open('/home/mayor/Pictures/current.jpg', 'rb')
-                    image_ids = twitter.upload_media(media=photo)
-                    twitter.update_status(status='It\'s snowing on ArmoryCam.com ❄ Tune in now! [' + now + ']',
-                                          media_ids=[image_ids['media_id']])
-                    success = True
+            delay = min(self._retry_base * 2 ** attempt, self._retry_max)
+            attempt += 1
+            if time.monotonic() + delay > deadline:
+                logger.error("Giving up on %s after %d attempts", channel.name, attempt)
+                return False
 
-                except Exception:
-                    print("Could not send update!")
-            else:
-                print("Notifications Disabled. Debugging Mode")
-                success = True
+            # Wakes early and gives up when stopping
+            if self.stopped.wait(delay):
+                return False
 
 
 class Snowtification():
@@ -226,32 +448,51 @@ class Snowtification():
     _notification_threshold = math.floor(constant.NOTIFY_EVENT_WINDOW_SECS * constant.NOTIFY_THRESHOLD)
     _stop_flag = None
     _notif_thread = None
-    _event_thread = None
 
-    def __init__(self, refrac_init):
+    # clock: Time source for the event window. Defaults to the monotonic clock,
+    #        pass a media clock to replay recordings faster than real time
+    # channels: Notification channels, defaults to Yo + Twitter
+    # journal: EventJournal the event window is restored from and written to
+    def __init__(self, refrac_init, clock=time.monotonic, channels=None, journal=None):
 
         self._snow_event = False
-        self._stopFlag = Event()  # Initialize timer stop flag
+        self._stop_flag = Event()  # Initialize timer stop flag
+        self._channels = channels
 
-        # Init Producer/Consumer Threads
-        self._notif_thread = NotificationThread(self._stop_flag)
-        self._event_thread = EventWindow(self._stopFlag, refrac_init)
+        # Init Producer/Consumer
+        self._notif_thread = NotificationThread(self._stop_flag, channels=channels)
+        self._snapshot = SnapshotBuffer(clock=clock)
+        self._event_window = EventWindow(refrac_init, clock=clock, notify=self._send_notification, journal=journal)
 
-        # Start Producer/Consumer Threads
+        # Start Consumer Thread
         self._notif_thread.start()
-        self._event_thread.start()
 
     def log_snow_event(self):
-        if self._event_thread.is_alive():
-            self._event_thread.increment_snow_event()
+        self._event_window.log_snow_event()
+
+    # Called for every analysed frame so seconds without snow are accounted for
+    def tick(self):
+        self._event_window.tick()
+
+    # Offer an analysed frame as the snapshot to attach to the next notification
+    def log_frame(self, frame, confidence):
+        self._snapshot.log_frame(frame, confidence)
+
+    def _send_notification(self, second=None):
+        notification = self._snapshot.notification()
+        EventWindow.send_notification(second, notification)
+        return notification.confidence
 
-    def stop_threads(self):
-        self._stopFlag.set()
-        notif_q.empty()
+    # Waits at most `timeout` seconds for a notification still being sent
+    def stop_threads(self, timeout=constant.NOTIF_STOP_TIMEOUT_SECS):
+        self._notif_thread.stop()
+        self._notif_thread.join(timeout)
+        if self._notif_thread.is_alive():
+            logger.warning("Notification thread still busy after %ds, not waiting for it", timeout)
 
     def start_threads(self):
-        notif_q.empty()
+        # Threads can only be started once, so start a fresh consumer
         self._stop_flag.clear()
+        self._notif_thread = NotificationThread(self._stop_flag, channels=self._channels)
         self._notif_thread.start()
-        self._event_thread.start()
-        self._event_thread.reset_vals()
+        self._event_window.reset_vals()
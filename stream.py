@@ -1,10 +1,13 @@
+import bisect
+import calendar
+import json
+import os
 import subprocess
 import constant
 import cv2
 import numpy as np
 import exceptions
 import api
-import signal
 import threading
 import sys
 try:
@@ -12,43 +15,298 @@ try:
 except ImportError:
     import queue
 import time
-import os
+import logging
+import select
+import zlib
+
+import metrics
+import pipeline
+
+logger = logging.getLogger(__name__)
+
+
+# Fixed ring of preallocated frames that a pipe reader fills in place.
+# Frames are handed out in order, so a frame stays valid until `size` more
+# frames have been taken from the pool.
+class FramePool(object):
+    def __init__(self, shape, size=constant.FRAME_POOL_SIZE):
+        if size < 1:
+            raise ValueError("Frame pool needs at least one frame")
+        self.shape = shape
+        self.size = size
+        self._frames = [np.empty(shape, dtype=np.uint8) for _ in range(size)]
+        # Flat byte views so readinto() can write straight into the arrays
+        self._views = [memoryview(frame).cast('B') for frame in self._frames]
+        self._idx = 0
+
+    # Return the next (frame, writable byte view) pair in the ring
+    def next_slot(self):
+        slot = self._frames[self._idx], self._views[self._idx]
+        self._idx = (self._idx + 1) % self.size
+        return slot
+
+
+# Fill `view` completely from `pipe`, handling short reads. With a timeout
+# the pipe must be unbuffered, and StreamTimeout is raised if the whole
+# frame does not arrive in time
+def read_into(pipe, view, timeout=None):
+    total = len(view)
+    filled = 0
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while filled < total:
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([pipe], [], [], remaining)[0]:
+                raise exceptions.StreamTimeout(message="no data from ffmpeg for %gs (%d of %d frame bytes)"
+                                                       % (timeout, filled, total))
+        count = pipe.readinto(view[filled:])
+        if not count:
+            raise exceptions.StreamError(message="ffmpeg pipe closed after %d of %d frame bytes" % (filled, total))
+        filled += count
+
+
+# Delay before restarting an ffmpeg process after `failures` restarts in a
+# row, doubling per failure up to a cap
+def restart_delay(failures, base=constant.STREAM_RESTART_BACKOFF_SECS,
+                  maximum=constant.STREAM_RESTART_MAX_BACKOFF_SECS):
+    return min(base * 2 ** failures, maximum)
+
+
+# Stop an ffmpeg process decoding into a pipe. Killed if it does not exit
+# in time, its stdout is closed either way
+def stop_decoder(proc, timeout=5):
+    proc.terminate()
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+    proc.stdout.close()
+
+
+#
+# Spots a frozen feed by fingerprinting every frame with a checksum of a
+# sparse grid of pixels, and counting how many frames in a row share the
+# same fingerprint. Costs a tiny copy per frame and holds no frame data.
+#
+class FrozenWatchdog(object):
+
+    def __init__(self, window, stride=constant.FINGERPRINT_STRIDE):
+        self.window = max(int(window), 2)
+        self.stride = stride
+        self.reset()
+
+    def reset(self):
+        self._fingerprint = None
+        self._repeats = 0
+
+    def fingerprint(self, frame):
+        return zlib.crc32(frame[::self.stride, ::self.stride].tobytes())
+
+    # Returns True once `window` consecutive frames were identical
+    def check(self, frame):
+        fingerprint = self.fingerprint(frame)
+        if fingerprint == self._fingerprint:
+            self._repeats += 1
+        else:
+            self._fingerprint = fingerprint
+            self._repeats = 0
+        return self._repeats >= self.window - 1
+
+
+#
+# ffmpeg argument list builder. ffmpeg is position sensitive: options apply
+# to the next -i (input options) or the next output target, so they are
+# collected per input and output and emitted in that order. The result is a
+# plain argv list for subprocess, no shell involved.
+#
+class FFmpegCommand(object):
+
+    # options: Global options, e.g. ['-nostdin']
+    def __init__(self, options=(), binary=constant.FFMPEG_PATH, loglevel=constant.FFMPEG_LOGLEVEL):
+        self._args = [binary, '-hide_banner', '-loglevel', loglevel] + [str(option) for option in options]
+
+    def input(self, source, *options):
+        self._args.extend(str(option) for option in options)
+        self._args.extend(['-i', source])
+        return self
+
+    def output(self, target, *options):
+        self._args.extend(str(option) for option in options)
+        self._args.append(target)
+        return self
+
+    def args(self):
+        return list(self._args)
+
+
+# Channels of each supported pipe pixel format
+PIX_FMT_CHANNELS = {'bgr24': 3, 'rgb24': 3, 'gray': 1}
+
+
+# Command decoding `url` to raw frames on stdout
+# filters:  -vf filter chain applied before the frames are piped out
+# fps:      Output frame rate, None leaves the rate to the filters
+def decode_command(url, filters=(), fps=None, pix_fmt=constant.FFMPEG_PIX_FMT,
+                   threads=constant.FFMPEG_DECODE_THREADS, low_delay=constant.FFMPEG_LOW_DELAY,
+                   analyzeduration=constant.FFMPEG_ANALYZE_DURATION_US, probesize=constant.FFMPEG_PROBE_SIZE,
+                   live_start_index=constant.FFMPEG_LIVE_START_INDEX):
+    # Nothing reads ffmpeg's stdin, don't let it wait on it for key presses
+    command = FFmpegCommand(['-nostdin'])
+
+    input_options = ['-threads', threads, '-analyzeduration', analyzeduration, '-probesize', probesize]
+    if low_delay:
+        input_options += ['-fflags', 'nobuffer', '-flags', 'low_delay']
+    if live_start_index is not None and url.split('?')[0].endswith('.m3u8'):
+        # HLS demuxer only option, other demuxers reject it
+        input_options += ['-live_start_index', live_start_index]
+    command.input(url, *input_options)
+
+    output_options = ['-an']
+    if fps:
+        output_options += ['-r', fps]
+    if filters:
+        output_options += ['-vf', ','.join(filters)]
+    output_options += ['-f', 'rawvideo', '-pix_fmt', pix_fmt]
+    return command.output('-', *output_options).args()
+
+
+# Command encoding raw bgr24 frames of width x height read from `source`
+# (a path, or '-' for stdin) to `target` in container `fmt`. A fmt of None
+# lets ffmpeg pick the container from the target's extension
+def encode_command(source, width, height, fps, target, fmt='flv', bitrate='3000k', gop=48):
+    # -y, an existing output file would otherwise make ffmpeg prompt on stdin
+    command = FFmpegCommand(['-y'], loglevel='error')
+    command.input(source, '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '%dx%d' % (width, height), '-r', fps)
+    return command.output(target,
+                          '-an',  # Tells FFMPEG not to expect any audio
+                          '-c:v', 'libx264', '-b:v', bitrate,
+                          '-preset', 'fast', '-tune', 'zerolatency',
+                          '-pix_fmt', 'yuv420p',
+                          '-g', gop,  # key frame distance
+                          '-threads', 0,
+                          *(['-f', fmt] if fmt else [])).args()
+
 
 class ArmoryCamStream(object):
-    width = 1920
-    height = 1080
-    channels = 3  # RGB
-    frame_num = 0
-    last_frame = None
-
-    def __init__(self):
-        self._proc = subprocess.Popen(
-            constant.FFMPEG_COMMAND,
-            stdin=subprocess.PIPE,
+
+    # scaled: Have ffmpeg scale the feed down to FrameSize inside the decoder
+    #         instead of piping full resolution frames into python
+    # crop:   Optional (x, y, width, height) rectangle in FrameSize coordinates
+    #         to crop the scaled frame to. Requires scaled=True
+    # analysis_fps: Optional frame rate to drop the feed to inside the decoder.
+    #         Skipped frames are never scaled or copied out of ffmpeg
+    # pool_size: Number of preallocated frames handed out in rotation. A frame
+    #         returned by next() is overwritten pool_size frames later
+    # url:    Stream to read, defaults to the armorycam feed
+    # pix_fmt: Pixel format ffmpeg hands out, 'gray' frames are 2D
+    def __init__(self, scaled=False, crop=None, analysis_fps=None, pool_size=constant.FRAME_POOL_SIZE,
+                 url=constant.STREAM_URL, pix_fmt=constant.FFMPEG_PIX_FMT):
+        if crop is not None and not scaled:
+            raise ValueError("Decoder crop requires a scaled stream")
+        if pix_fmt not in PIX_FMT_CHANNELS:
+            raise ValueError("Unsupported pipe pixel format: %s" % pix_fmt)
+
+        self.url = url
+        self.pix_fmt = pix_fmt
+        self.channels = PIX_FMT_CHANNELS[pix_fmt]
+        self.scaled = scaled
+        self.crop = crop
+        self.analysis_fps = analysis_fps
+
+        if crop is not None:
+            self.width = crop[2]
+            self.height = crop[3]
+        elif scaled:
+            self.width = constant.FrameSize.WIDTH.value
+            self.height = constant.FrameSize.HEIGHT.value
+        else:
+            self.width = constant.SourceFrameSize.WIDTH.value
+            self.height = constant.SourceFrameSize.HEIGHT.value
+
+        shape = (self.height, self.width) if self.channels == 1 else (self.height, self.width, self.channels)
+        self._pool = FramePool(shape, size=pool_size)
+        frame_rate = analysis_fps or constant.SOURCE_FPS
+        self._watchdog = FrozenWatchdog(constant.FROZEN_STREAM_SECS * frame_rate)
+        self._closed = False
+        self._receiving = False      # Has a frame arrived since ffmpeg was (re)started
+        self._failed_restarts = 0    # Restarts since the feed was last healthy
+        self._healthy_frames = 0     # Frames passed by the watchdog since ffmpeg was (re)started
+        self._proc = self._open_ffmpeg()
+
+    def _video_filters(self):
+        filters = []
+        # Drop frames first so that the skipped ones never reach the scaler
+        if self.analysis_fps:
+            filters.append("fps=%g" % self.analysis_fps)
+        if self.scaled:
+            filters.append("scale=%d:%d:flags=area" % (constant.FrameSize.WIDTH.value,
+                                                       constant.FrameSize.HEIGHT.value))
+        if self.crop is not None:
+            x, y, width, height = self.crop
+            filters.append("crop=%d:%d:%d:%d" % (width, height, x, y))
+        return filters
+
+    def _ffmpeg_command(self):
+        # An output '-r' would duplicate dropped frames back up to the source rate
+        return decode_command(self.url, filters=self._video_filters(),
+                              fps=None if self.analysis_fps else constant.SOURCE_FPS, pix_fmt=self.pix_fmt)
+
+    def _open_ffmpeg(self):
+        return subprocess.Popen(
+            self._ffmpeg_command(),
+            stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
-            shell=True,
-            bufsize=-1,
+            # Unbuffered so select() sees exactly what is left in the pipe
+            bufsize=0,
         )
 
     # Define custom iterator for CamStream object that will grab a new frame each
     # step
     def __next__(self):
-        try:
-            raw_bytes = self._proc.stdout.read(self.height * self.width * self.channels)
-            np_frame = np.frombuffer(raw_bytes, dtype=np.uint8).reshape((self.height, self.width, self.channels))
-        except Exception as e:
-            raise exceptions.StreamError(err_obj=e)
-
-        # Check every 100th frame to see if stream is frozen
-        # If stream is frozen, restart ffmpeg
-        self.frame_num += 1
-        if self.frame_num > 99:
-            if np.array_equal(self.last_frame, np_frame):
-                self.restart_ffmpeg()
-            self.frame_num = 0
-            self.last_frame = np_frame
-
-        return np_frame
+        while True:
+            np_frame, view = self._pool.next_slot()
+            # The first frame after a (re)start takes a while to arrive
+            timeout = constant.STREAM_READ_TIMEOUT_SECS if self._receiving else constant.STREAM_START_TIMEOUT_SECS
+            start = time.perf_counter()
+            try:
+                read_into(self._proc.stdout, view, timeout=timeout)
+            except exceptions.StreamTimeout:
+                self._recover('stalled')
+                continue
+            except exceptions.StreamError:
+                self._recover('closed')
+                continue
+            except Exception as e:
+                raise exceptions.StreamError(err_obj=e)
+            metrics.STAGE_LATENCY.observe(time.perf_counter() - start, 'decode')
+            metrics.FRAMES_DECODED.inc()
+
+            # If stream is frozen, restart ffmpeg
+            if self._watchdog.check(np_frame):
+                self._recover('frozen')
+                continue
+
+            self._receiving = True
+            # Only a full watchdog window of frames proves the feed recovered,
+            # a frozen feed or dying ffmpeg still delivers a few frames first
+            self._healthy_frames += 1
+            if self._healthy_frames >= self._watchdog.window:
+                self._failed_restarts = 0
+            return np_frame
+
+    # Restart ffmpeg with exponential backoff, give up after too many
+    # restarts in a row without the feed becoming healthy
+    def _recover(self, reason):
+        if self._closed:
+            raise exceptions.StreamError(message="stream closed")
+        if self._failed_restarts >= constant.STREAM_MAX_RESTARTS:
+            raise exceptions.StreamError(message="giving up after %d ffmpeg restarts (last: %s)"
+                                                 % (self._failed_restarts, reason))
+
+        delay = restart_delay(self._failed_restarts)
+        self._failed_restarts += 1
+        self.restart_ffmpeg(reason=reason, delay=delay)
 
     # Calling ArmoryCamStream.next() will have same functionality as
     # ArmoryCamStream.__next__()
@@ -58,17 +316,22 @@ class ArmoryCamStream(object):
         return self
 
     def close(self):
-        self._proc.terminate()
-
-    def restart_ffmpeg(self):
-        self.close()
-        self._proc = subprocess.Popen(
-            constant.FFMPEG_COMMAND,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            shell=True,
-            bufsize=-1,
-        )
+        self._closed = True
+        self._stop_ffmpeg()
+
+    def _stop_ffmpeg(self):
+        stop_decoder(self._proc)
+
+    def restart_ffmpeg(self, reason='requested', delay=0):
+        logger.warning("Restarting ffmpeg reason=%s delay=%gs", reason, delay)
+        metrics.FFMPEG_RESTARTS.inc(1, reason)
+        self._stop_ffmpeg()
+        if delay:
+            time.sleep(delay)
+        self._watchdog.reset()
+        self._receiving = False
+        self._healthy_frames = 0
+        self._proc = self._open_ffmpeg()
 
     def __enter__(self):
         return self
@@ -78,20 +341,40 @@ class ArmoryCamStream(object):
 
 
 class FileStream(object):
-    def __init__(self, filepath, offset=0):
+    # analysis_fps: Optional frame rate to analyse the file at. Frames in between
+    #               are grabbed without being decoded into python
+    def __init__(self, filepath, offset=0, analysis_fps=None):
         self._capture = cv2.VideoCapture(filepath)
         self._capture.set(cv2.CAP_PROP_POS_FRAMES, offset)
 
+        self.frame_hop = 1
+        if analysis_fps:
+            file_fps = self._capture.get(cv2.CAP_PROP_FPS) or constant.SOURCE_FPS
+            self.frame_hop = max(1, int(round(file_fps / analysis_fps)))
+
     def close(self):
         self._capture.release()
 
+    # Position in the file in seconds, usable as a media clock
+    def timestamp(self):
+        return self._capture.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+
     def __next__(self):
+        start = time.perf_counter()
         try:
+            # grab() demuxes and decodes but skips the copy out of the decoder
+            for _ in range(self.frame_hop - 1):
+                if not self._capture.grab():
+                    raise exceptions.StreamError(message="Failed Iteration inside of stream.next()")
             success, frame = self._capture.read()
             if not success:
                 raise exceptions.StreamError(message="Failed Iteration inside of stream.next()")
+        except exceptions.StreamError:
+            raise
         except Exception as e:
             raise exceptions.StreamError(err_obj=e)
+        metrics.STAGE_LATENCY.observe(time.perf_counter() - start, 'decode')
+        metrics.FRAMES_DECODED.inc()
         return frame
 
     next = __next__
@@ -106,102 +389,338 @@ class FileStream(object):
         self.close()
 
 
+#
+# Keyframe index of a video file. Built once with ffprobe from the packet
+# list (no decoding) and cached next to the file as <file>.keyframes.json,
+# rebuilt when the file's size or modification time change.
+#
+class KeyframeIndex(object):
+    VERSION = 2
+
+    # keyframes:   Sorted (frame number, seconds from the start of the video) pairs
+    # recorded_at: Unix time the first frame was recorded
+    def __init__(self, frames, fps, width, height, start_time, keyframes, recorded_at):
+        self.frames = frames
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.start_time = start_time
+        self.keyframes = keyframes
+        self.recorded_at = recorded_at
+        self._keyframe_numbers = [frame for frame, _ in keyframes]
+
+    @staticmethod
+    def cache_path(path):
+        return path + '.keyframes.json'
+
+    @classmethod
+    def load(cls, path):
+        stat = os.stat(path)
+        try:
+            with open(cls.cache_path(path)) as cache_file:
+                cached = json.load(cache_file)
+            if (cached['version'], cached['size'], cached['mtime']) == (cls.VERSION, stat.st_size, stat.st_mtime):
+                return cls(cached['frames'], cached['fps'], cached['width'], cached['height'],
+                           cached['start_time'], [tuple(keyframe) for keyframe in cached['keyframes']],
+                           cached['recorded_at'])
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        index = cls.build(path)
+        try:
+            with open(cls.cache_path(path), 'w') as cache_file:
+                json.dump({'version': cls.VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                           'frames': index.frames, 'fps': index.fps, 'width': index.width, 'height': index.height,
+                           'start_time': index.start_time, 'keyframes': index.keyframes,
+                           'recorded_at': index.recorded_at}, cache_file)
+        except (IOError, OSError) as e:
+            logger.warning("Could not cache keyframe index of %s: %s", path, e)
+        return index
+
+    @classmethod
+    def build(cls, path):
+        probe = [constant.FFPROBE_PATH, '-v', 'error', '-select_streams', 'v:0']
+        try:
+            info = json.loads(subprocess.check_output(
+                probe + ['-show_entries', 'stream=width,height,avg_frame_rate,start_time:format_tags=creation_time',
+                         '-of', 'json', path]))
+            stream = info['streams'][0]
+        except (OSError, subprocess.CalledProcessError, ValueError, KeyError, IndexError) as e:
+            raise exceptions.StreamError(err_obj=e, message="Could not probe %s" % path)
+
+        num, _, den = stream.get('avg_frame_rate', '0/0').partition('/')
+        fps = float(num) / float(den) if den and float(den) else float(constant.SOURCE_FPS)
+        start_time = float(stream.get('start_time') or 0)
+
+        # Packets come in decode order, frame numbers follow presentation order
+        pts, keys = [], []
+        proc = subprocess.Popen(probe + ['-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', path],
+                                stdout=subprocess.PIPE, universal_newlines=True)
+        for line in proc.stdout:
+            pts_time, _, flags = line.strip().partition(',')
+            if not pts_time or pts_time == 'N/A':
+                continue
+            pts.append(float(pts_time))
+            if 'K' in flags:
+                keys.append(float(pts_time))
+        if proc.wait():
+            raise exceptions.StreamError(message="ffprobe failed to index %s" % path)
+
+        pts.sort()
+        keyframes = [(bisect.bisect_left(pts, key), key - start_time) for key in sorted(keys)]
+        if not keyframes or keyframes[0][0] != 0:
+            keyframes.insert(0, (0, 0.0))
+
+        # Recorders stamp the container with the time recording started,
+        # otherwise assume the file was last written when recording ended
+        recorded_at = None
+        creation_time = info.get('format', {}).get('tags', {}).get('creation_time')
+        if creation_time:
+            try:
+                recorded_at = calendar.timegm(time.strptime(creation_time[:19], '%Y-%m-%dT%H:%M:%S'))
+            except ValueError:
+                pass
+        if recorded_at is None:
+            recorded_at = os.path.getmtime(path) - len(pts) / fps
+        return cls(len(pts), fps, int(stream['width']), int(stream['height']), start_time, keyframes, recorded_at)
+
+    # (frame number, seconds) of the last keyframe at or before `frame`
+    def keyframe_before(self, frame):
+        return self.keyframes[max(bisect.bisect_right(self._keyframe_numbers, frame) - 1, 0)]
+
+    def frame_at(self, seconds):
+        return int(seconds * self.fps)
+
+
+#
+# Frame range reader for a video file. Decoding starts at the keyframe at or
+# before start_frame, so the seek is exact and cheap, and the frames between
+# the keyframe and start_frame double as MOG2 warm up. Several readers can
+# decode different ranges of one file in parallel. Frames are decoded by
+# ffmpeg and piped into a FramePool like ArmoryCamStream; `frame` is the
+# number of the frame returned last.
+#
+class SeekableFileStream(object):
+    channels = 3
+
+    # start_time: Seconds into the video, overrides start_frame
+    # end_frame:  Stop before this frame, None reads to the end of the file
+    # frame_hop:  Only hand out frames n with n % frame_hop == frame_hop - 1,
+    #             the others are dropped inside ffmpeg. Defaults from analysis_fps
+    def __init__(self, filepath, start_frame=0, end_frame=None, start_time=None, analysis_fps=None, frame_hop=None,
+                 pool_size=constant.FRAME_POOL_SIZE, threads=constant.FFMPEG_DECODE_THREADS, index=None):
+        self.filepath = filepath
+        self.index = index or KeyframeIndex.load(filepath)
+        if start_time is not None:
+            start_frame = self.index.frame_at(start_time)
+        if frame_hop is None:
+            frame_hop = max(1, int(round(self.index.fps / analysis_fps))) if analysis_fps else 1
+        self.frame_hop = frame_hop
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+
+        keyframe, keyframe_time = self.index.keyframe_before(start_frame)
+        self.first_frame = keyframe
+        self.frame = None
+        # First frame number the hop lets through
+        self._next_frame = keyframe + (frame_hop - 1 - keyframe) % frame_hop
+
+        self._pool = FramePool((self.index.height, self.index.width, self.channels), size=pool_size)
+        self._proc = subprocess.Popen(self._ffmpeg_command(keyframe, keyframe_time, threads),
+                                      stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, bufsize=0)
+
+    def _ffmpeg_command(self, keyframe, keyframe_time, threads):
+        command = FFmpegCommand(['-nostdin'])
+        input_options = ['-threads', threads]
+        if keyframe:
+            # Seek straight to the keyframe and keep every frame from there.
+            # Aim half a frame past it so rounding never lands on the one before
+            input_options += ['-ss', '%.6f' % (keyframe_time + .5 / self.index.fps), '-noaccurate_seek']
+        command.input(self.filepath, *input_options)
+
+        hop = self.frame_hop
+        output_options = ['-an', '-vsync', 'passthrough']
+        if hop > 1:
+            output_options += ['-vf', 'select=eq(mod(n+%d\\,%d)\\,%d)' % (keyframe, hop, hop - 1)]
+        if self.end_frame is not None:
+            output_options += ['-frames:v', max(self.end_frame // hop - keyframe // hop, 0)]
+        output_options += ['-f', 'rawvideo', '-pix_fmt', 'bgr24']
+        return command.output('-', *output_options).args()
+
+    # Position in the video in seconds, usable as a media clock
+    def timestamp(self):
+        return (self.first_frame if self.frame is None else self.frame) / self.index.fps
+
+    # Unix time the current frame was recorded at, a media clock in wall
+    # clock time
+    def recorded_time(self):
+        return self.index.recorded_at + self.timestamp()
+
+    # The next frame comes before start_frame and is only decoded because
+    # decoding starts at a keyframe
+    @property
+    def warming_up(self):
+        return self._next_frame < self.start_frame
+
+    def __next__(self):
+        if self.end_frame is not None and self._next_frame >= self.end_frame:
+            raise exceptions.StreamError(message="End of range")
+
+        np_frame, view = self._pool.next_slot()
+        start = time.perf_counter()
+        try:
+            read_into(self._proc.stdout, view)
+        except exceptions.StreamError:
+            raise exceptions.StreamError(message="End of file %s" % self.filepath)
+        except Exception as e:
+            raise exceptions.StreamError(err_obj=e)
+        metrics.STAGE_LATENCY.observe(time.perf_counter() - start, 'decode')
+        metrics.FRAMES_DECODED.inc()
+
+        self.frame = self._next_frame
+        self._next_frame += self.frame_hop
+        return np_frame
+
+    next = __next__
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        stop_decoder(self._proc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+#
+# Restreams frames through an ffmpeg encoder. Raw uint8 BGR frames are written
+# straight into ffmpeg's stdin by a dedicated writer thread, fed by a bounded
+# queue that drops the oldest frame when the encoder falls behind, so the
+# detection loop never blocks on it. The encoder is restarted (with backoff)
+# when its pipe breaks.
+#
 class OutputStream(object):
-    def __init__(self, width=480, height=270, fps=24, verbose=False):
-        self.twitch_stream_key = api.TWITCH_STREAM_KEY
+
+    # target: Where the encoded stream goes, defaults to the twitch ingest.
+    #         A file path, or '-' with fmt='null' to only exercise the encoder
+    # fmt:    Output container, None guesses it from the target file name
+    def __init__(self, width=constant.FrameSize.WIDTH.value, height=constant.FrameSize.HEIGHT.value,
+                 fps=constant.SOURCE_FPS, target=None, fmt=None, queue_size=constant.RESTREAM_QUEUE_SIZE,
+                 verbose=False):
         self.width = width
         self.height = height
         self.fps = fps
-        self.ffmpeg_process = None
-        self.video_pipe = None
-        self.ffmpeg_binary = constant.FFMPEG_PATH
+        if target is None:
+            target, fmt = api.TWITCH_STREAM_KEY, 'flv'
+        self.target = target
+        self.fmt = fmt
         self.verbose = verbose
+        self.restarts = 0
+        self.ffmpeg_process = None
+        self._closed = False
+        self._queue = pipeline.FrameQueue(maxsize=queue_size, name='restream')
 
         # Try to open a new ffmpeg process
         try:
             self.reset()
         except OSError:
-            print("ffmpeg not installed at %s" % self.ffmpeg_binary)
+            logger.critical("ffmpeg not installed at %s", constant.FFMPEG_PATH)
             sys.exit(1)
 
-    def reset(self):
+        self._writer = threading.Thread(target=self._run, name='restream')
+        self._writer.daemon = True
+        self._writer.start()
+
+    @property
+    def dropped(self):
+        return self._queue.dropped
+
+    def reset(self, reason=None):
         """
         Reset the videostream by restarting ffmpeg
         """
-
         if self.ffmpeg_process is not None:
-            # Close the previous stream
-            try:
-                self.ffmpeg_process.terminate()
-            except OSError:
-                pass
+            self._stop_encoder()
+            self.restarts += 1
+            metrics.FFMPEG_RESTARTS.inc(1, reason or 'encoder')
 
-        command = [
-            constant.FFMPEG_PATH,
-            '-loglevel', 'info',
-            '-i', '/tmp/videopipe',  # The input comes from a pipe
-            '-f', 'rawvideo',
-            '-videocodec', 'rawvideo',
-            '-r', '24',  # set a fixed frame rate
-            '-c:v', 'libx264',
-            # size of one frame
-            '-s', str(self.width) + 'x' + str(self.height),
-            '-an',  # Tells FFMPEG not to expect any audio
-            '-b:v', '3000k',
-            '-preset', 'fast', '-tune', 'zerolatency',
-            '-pix_fmt', 'yuv440p',
-            '-g', '48',  # key frame distance
-
-            # NUMBER OF THREADS
-            '-threads', '0',
-
-            # STREAM TO TWITCH
-            '-f', 'flv', '%s' % api.TWITCH_STREAM_KEY
-        ]
-
-        command = " ".join(command)
-
-        devnullpipe = open("/dev/null", "w")  # Throw away stream
-
-        if self.verbose:
-            devnullpipe = None
+        output = None if self.verbose else subprocess.DEVNULL
         self.ffmpeg_process = subprocess.Popen(
-            command,
+            encode_command('-', self.width, self.height, self.fps, self.target, fmt=self.fmt),
             stdin=subprocess.PIPE,
-            stderr=devnullpipe,
-            stdout=devnullpipe,
-            bufsize=-1
+            stdout=output,
+            stderr=output,
+            # Unbuffered, frames are written in one go straight from the array
+            bufsize=0,
         )
 
-    def __enter__(self):
-        return self
-
-    def __exit__(self, type, value, traceback):
-        # sigint so avconv can clean up the stream nicely
-        self.ffmpeg_process.send_signal(signal.SIGINT)
-        # waiting doesn't work because of reasons I don't know
-        # self.pipe.wait()
+    def _stop_encoder(self):
+        # EOF on stdin lets ffmpeg flush and finalise the output
+        try:
+            self.ffmpeg_process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.ffmpeg_process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.ffmpeg_process.kill()
+            self.ffmpeg_process.wait()
 
     def send_video_frame(self, frame):
-        """Send frame of shape (height, width, 3)
-        with values between 0 and 1.
-        Raises an OSError when the stream is closed.
-        :param frame: array containing the frame.
-        :type frame: numpy array with shape (height, width, 3)
-            containing values between 0.0 and 1.0
+        """Queue a uint8 BGR frame of shape (height, width, 3) for encoding.
+        Never blocks, the oldest queued frame is dropped when the encoder lags.
+        The frame must not be modified after it is sent.
         """
-        if self.video_pipe is None:
-            if not os.path.exists('/tmp/videopipe'):
-                os.mkfifo('/tmp/videopipe')
-            self.video_pipe = os.open('/tmp/videopipe', os.O_WRONLY)
+        if frame.shape != (self.height, self.width, 3) or frame.dtype != np.uint8:
+            raise ValueError("Expected a uint8 frame of shape %s, got %s %s"
+                             % ((self.height, self.width, 3), frame.dtype, frame.shape))
+        self._queue.put(np.ascontiguousarray(frame))
+
+    def _write(self, frame):
+        view = memoryview(frame).cast('B')
+        written = 0
+        while written < len(view):
+            written += self.ffmpeg_process.stdin.write(view[written:])
+
+    def _run(self):
+        failures = 0
+        for frame in self._queue:
+            start = time.perf_counter()
+            try:
+                self._write(frame)
+            except OSError as e:
+                if self._closed:
+                    break
+                delay = restart_delay(failures)
+                failures += 1
+                logger.warning("Restarting encoder after write failure: %s delay=%gs", e, delay)
+                time.sleep(delay)
+                if self._closed:
+                    break
+                try:
+                    self.reset(reason='encoder')
+                except OSError as e:
+                    logger.error("Could not restart encoder: %s", e)
+                continue
+            failures = 0
+            metrics.STAGE_LATENCY.observe(time.perf_counter() - start, 'restream')
 
-        assert frame.shape == (self.height, self.width, 3)
+    def close(self):
+        self._closed = True
+        self._queue.close()
+        self._writer.join(5)
+        if self._writer.is_alive():
+            # Stuck writing to a hung encoder, killing it breaks the write
+            self.ffmpeg_process.kill()
+            self._writer.join()
+        self._stop_encoder()
 
-        frame = np.clip(255 * frame, 0, 255).astype('uint8')
-        try:
-            os.write(self.video_pipe, frame.tostring())
-            print("Wrote to pipe!")
-        except OSError:
-            # The pipe has been closed. Reraise and handle it further
-            # downstream
-            raise
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()